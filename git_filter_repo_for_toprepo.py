@@ -3641,9 +3641,12 @@ class RepoFilter(object):
       sys.stdin = None # Make sure no one tries to accidentally use it
       self._fe_orig = None
     else:
+      # git-toprepo: The source objects might already be available in the
+      # target, e.g. after fetching, then the blob contents are not needed.
       skip_blobs = (self._blob_callback is None and
                     self._args.replace_text is None and
-                    self._args.source == self._args.target)
+                    (self._args.source == self._args.target or
+                     getattr(self._args, 'source_objects_in_target', False)))
       extra_flags = []
       if skip_blobs:
         extra_flags.append('--no-data')
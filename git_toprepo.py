@@ -4,30 +4,35 @@
 git-toprepo merges subrepositories into a common history, similar to git-subtree.
 """
 import argparse
+import copy
+import heapq
 import itertools
 import os
 import re
+import shlex
 import shutil
 import subprocess
 import sys
 import textwrap
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from collections import ChainMap, defaultdict, deque
 from dataclasses import dataclass
 from functools import cached_property, lru_cache, partial
 from pathlib import Path, PurePath, PurePosixPath
-from queue import PriorityQueue
 from typing import (
     Any,
+    Callable,
+    Container,
     DefaultDict,
     Dict,
     Generator,
     Iterable,
     List,
+    Mapping,
     Optional,
     Set,
     Tuple,
-    TypeVar,
     Union,
 )
 
@@ -77,61 +82,113 @@ class Repo:
     def git_dir(self) -> Path:
         return determine_git_dir(self.path)
 
+    @cached_property
+    def cat_file(self) -> "GitCatFileBatch":
+        return GitCatFileBatch(self.path)
+
+
+class GitCatFileBatch:
+    """Reads objects using a single long running `git cat-file --batch`."""
+
+    def __init__(self, repo: Path):
+        self.repo = repo
+        self.process: Optional[subprocess.Popen] = None
+
+    def read(self, object_name: str) -> Optional[bytes]:
+        """Returns the content of e.g. `<ref>:<path>`, None if it is missing."""
+        result = self._request(object_name)
+        return None if result is None else result[1]
+
+    def resolve(self, object_name: str) -> Optional[CommitHash]:
+        """Returns the hash of e.g. `<ref>^{commit}`, None if it is missing."""
+        result = self._request(object_name)
+        return None if result is None else result[0]
+
+    def _request(self, object_name: str) -> Optional[Tuple[bytes, bytes]]:
+        if self.process is None:
+            self.process = subprocess.Popen(
+                ["git", "-C", str(self.repo), "cat-file", "--batch"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+        assert self.process.stdin is not None
+        assert self.process.stdout is not None
+        self.process.stdin.write(object_name.encode("utf-8") + b"\n")
+        self.process.stdin.flush()
+        # <oid> SP <type> SP <size> LF <content> LF
+        # or <object> SP missing LF, where <object> may contain spaces.
+        header = self.process.stdout.readline()
+        if header == b"":
+            raise RuntimeError(f"git cat-file --batch in {self.repo} exited")
+        if header.endswith((b" missing\n", b" ambiguous\n")):
+            return None
+        oid, _, size = header.rstrip(b"\n").rsplit(b" ", 2)
+        content = self.process.stdout.read(int(size))
+        self.process.stdout.read(1)
+        return oid, content
+
+    def close(self) -> None:
+        if self.process is not None:
+            process = self.process
+            self.process = None
+            assert process.stdin is not None
+            assert process.stdout is not None
+            process.stdin.close()
+            process.stdout.close()
+            process.wait()
+
+    def __del__(self):
+        self.close()
+
 
 class MonoRepo(Repo):
     name: str = "mono repo"
 
     def __init__(self, repo: Path):
         toplevel_repo_dir = Path(
-            subprocess.check_output(
-                ["git", "-C", str(repo), "rev-parse", "--show-toplevel"],
-                text=True,
-            ).rstrip("\n")
+            git_output(repo, ["rev-parse", "--show-toplevel"]).rstrip("\n")
         )
         super().__init__(toplevel_repo_dir)
 
+    @cached_property
+    def git_config(self) -> "ConfigDict":
+        """The git configuration, read once using a single `git config --list`."""
+        return LocalGitConfigLoader(self).get_config_dict()
+
+    def set_git_config(self, key: str, value: str) -> None:
+        """Writes a git configuration and keeps `git_config` up to date.
+
+        `key` must be given on the lower case form of `git config --list`.
+        """
+        subprocess.check_call(["git", "-C", str(self.path), "config", key, value])
+        self.git_config[key] = [value]
+
     @lru_cache
     def get_toprepo_fetch_url(self) -> Url:
         fetch_url = self.get_toprepo_fetch_url_impl("remote.origin.url", False)
         if fetch_url is None or fetch_url == "file:///dev/null":
             # TODO: 2024-04-29 Remove after migration.
-            fetch_url = self.get_toprepo_fetch_url_impl("toprepo.top.fetchUrl", True)
+            fetch_url = self.get_toprepo_fetch_url_impl("toprepo.top.fetchurl", True)
             assert fetch_url, "could not find fetch url"
-            subprocess.check_output(
-                ["git", "-C", str(self.path), "config", "remote.origin.url", fetch_url],
-                text=True,
-            ).rstrip()
-            subprocess.check_output(
-                ["git", "-C", str(self.path)]
-                + ["config", "remote.origin.pushUrl", "file:///dev/null"],
-                text=True,
-            ).rstrip()
+            self.set_git_config("remote.origin.url", fetch_url)
+            self.set_git_config("remote.origin.pushurl", "file:///dev/null")
         # TODO: 2024-04-29 Remove after migration.
-        push_url = self.get_toprepo_fetch_url_impl("remote.top.pushUrl", False)
+        push_url = self.get_toprepo_fetch_url_impl("remote.top.pushurl", False)
         if push_url is None:
-            push_url = self.get_toprepo_fetch_url_impl("toprepo.top.pushUrl", True)
+            push_url = self.get_toprepo_fetch_url_impl("toprepo.top.pushurl", True)
             assert push_url, "could not find push url"
-            subprocess.check_output(
-                ["git", "-C", str(self.path), "config", "remote.top.pushUrl", push_url],
-                text=True,
-            ).rstrip()
+            self.set_git_config("remote.top.pushurl", push_url)
         return fetch_url
 
     def get_toprepo_fetch_url_impl(self, toprepo_fetchurl_key, throw) -> Optional[Url]:
-        try:
-            fetch_url = subprocess.check_output(
-                ["git", "-C", str(self.path), "config", toprepo_fetchurl_key], text=True
-            ).rstrip()
-        except subprocess.CalledProcessError as err:
-            if err.returncode == 1:
-                if throw:
-                    raise ValueError(
-                        f"git-config {toprepo_fetchurl_key} is missing in {self.path}"
-                    )
-                else:
-                    return None
-            raise
-        return fetch_url
+        values = self.git_config.get(toprepo_fetchurl_key)
+        if values is None:
+            if throw:
+                raise ValueError(
+                    f"git-config {toprepo_fetchurl_key} is missing in {self.path}"
+                )
+            return None
+        return values[-1]
 
     def get_toprepo_dir(self) -> Path:
         return self.get_subrepo_dir(TopRepo.name)
@@ -167,6 +224,8 @@ class TopRepo(Repo):
 
 @dataclass(frozen=True)
 class PushRefSpec:
+    __slots__ = ("local_ref", "remote_ref")
+
     local_ref: RefStr
     remote_ref: RefStr
 
@@ -184,6 +243,8 @@ class PushRefSpec:
 
 @dataclass(frozen=True)
 class PushInstruction:
+    __slots__ = ("repo", "commit_hash", "extra_args")
+
     repo: Union["TopRepo", "SubRepo"]
     commit_hash: CommitHash
     extra_args: List[str]
@@ -192,21 +253,10 @@ class PushInstruction:
         return self.repo.path == other.repo.path and self.extra_args == other.extra_args
 
 
-_T = TypeVar("_T")
-
-
-def unique_append(dest: List[_T], item: _T):
-    if item not in dest:
-        dest.append(item)
-
-
-def unique_extend(dest: List[_T], items: Iterable[_T]):
-    for item in items:
-        unique_append(dest, item)
-
-
-def try_relative_path(path: Path, other: Path = Path.cwd()) -> Path:
-    """Returns a relative path, if possible."""
+def try_relative_path(path: Path, other: Optional[Path] = None) -> Path:
+    """Returns a relative path, if possible, by default to the current directory."""
+    if other is None:
+        other = Path.cwd()
     try:
         return path.relative_to(other)
     except ValueError:
@@ -222,15 +272,15 @@ def determine_git_dir(repo: Path) -> Path:
 
 @dataclass(frozen=True)
 class GitModuleInfo:
+    # dataclass(slots=True) requires Python 3.10.
+    __slots__ = ("name", "path", "branch", "url", "raw_url")
+
     name: str
     path: PurePosixPath
     branch: Optional[str]
     url: Url
     raw_url: RawUrl
 
-    def __hash__(self) -> int:
-        return hash((self.name, self.path, self.branch, self.url, self.raw_url))
-
 
 def removesuffix(text: str, suffix: str) -> str:
     # Available in Python 3.9.
@@ -239,15 +289,22 @@ def removesuffix(text: str, suffix: str) -> str:
     return text
 
 
+@lru_cache(maxsize=8192)
 def repository_basename(repository: Url) -> str:
     # For both an URL and a file path, assume a limited set of separators.
-    idx = max(repository.rfind(sep) for sep in r"/\:")
-    # idx+1 also works if no separator was found.
-    basename = repository[idx + 1 :]
-    basename = removesuffix(basename, ".git")
-    return basename
+    start = max(repository.rfind(sep) for sep in r"/\:") + 1
+    # start == 0 also works if no separator was found.
+    end = len(repository)
+    if repository.endswith(".git") and end - start >= 4:
+        end -= 4
+    return repository[start:end]
+
 
+# For both an URL and a file path, assume a limited set of separators.
+repository_name_separators = str.maketrans(dict.fromkeys("/\\:", "-"))
 
+
+@lru_cache(maxsize=8192)
 def repository_name(repository: Url) -> str:
     name = repository
     # Handle relative paths.
@@ -256,50 +313,53 @@ def repository_name(repository: Url) -> str:
     # Remove scheme.
     idx = name.find("://")
     if idx != -1:
-        name = name[idx + 3 :]
-        # Remove the domain name.
-        idx = name.find("/")
-        # idx+1 also works if no separator was found.
-        name = name[idx + 1 :]
+        # Remove the domain name, if any.
+        domain_start = idx + 3
+        idx = name.find("/", domain_start)
+        name = name[idx + 1 if idx != -1 else domain_start :]
     # Annoying with double slash.
     name = name.replace("//", "/")
     name = name.strip("/")
     name = removesuffix(name, ".git")
-    # For both an URL and a file path, assume a limited set of separators.
-    for sep in r"/\:":
-        name = name.replace(sep, "-")
-    return name
+    return name.translate(repository_name_separators)
 
 
+@lru_cache(maxsize=8192)
 def join_submodule_url(parent: Url, other: RawUrl) -> Url:
-    if other.startswith("./") or other.startswith("../") or other == ".":
-        idx = parent.find("://")
-        scheme_end = idx + 3 if idx != -1 else idx + 1
-        scheme = parent[:scheme_end]
-        parent = parent[scheme_end:]
-        parent = parent.rstrip("/")
-        while True:
-            if other.startswith("/"):
-                # Ignore double slash.
-                other = other[1:]
-            elif other.startswith("./"):
-                other = other[2:]
-            elif other.startswith("../"):
-                idx = parent.rfind("/")
+    if not (other.startswith("./") or other.startswith("../") or other == "."):
+        return other
+    idx = parent.find("://")
+    scheme_end = idx + 3 if idx != -1 else 0
+    # Work with indices into parent and other to avoid intermediate strings.
+    parent_end = len(parent)
+    while parent_end > scheme_end and parent[parent_end - 1] == "/":
+        parent_end -= 1
+    too_many_dotdots = False
+    pos = 0
+    while True:
+        if other.startswith("/", pos):
+            # Ignore double slash.
+            pos += 1
+        elif other.startswith("./", pos):
+            pos += 2
+        elif other.startswith("../", pos):
+            if too_many_dotdots:
+                too_many_dotdots = False
+            else:
+                idx = parent.rfind("/", scheme_end, parent_end)
                 if idx != -1:
-                    parent = parent[:idx]
+                    parent_end = idx
                 else:
                     # Too many '../', move it from other to parent.
-                    parent += "/.."
-                other = other[3:]
-            else:
-                break
-        if other in ("", "."):
-            ret = f"{scheme}{parent}"
+                    too_many_dotdots = True
+            pos += 3
         else:
-            ret = f"{scheme}{parent}/{other}"
-    else:
-        ret = other
+            break
+    ret = parent[:parent_end]
+    if too_many_dotdots:
+        ret += "/.."
+    if pos < len(other) and other[pos:] != ".":
+        ret += "/" + other[pos:]
     return ret
 
 
@@ -309,14 +369,17 @@ ANNOTATED_TOP_SUBDIR = b"<top>"
 def annotate_message(
     message: bytes, subdir: bytes, orig_commit_hash: CommitHash
 ) -> bytes:
-    ret = message.rstrip(b"\n") + b"\n"
-    if b"\n\n" not in ret:
+    message = message.rstrip(b"\n")
+    if b"\n\n" in message:
+        separator = b"\n"
+    else:
         # Subject only, no message body.
         # Add another LF to avoid folding into the subject line
         # in 'git log --oneline'.
-        ret += b"\n"
-    ret += b"^-- " + subdir + b" " + orig_commit_hash + b"\n"
-    return ret
+        separator = b"\n\n"
+    return b"".join(
+        (message, separator, b"^-- ", subdir, b" ", orig_commit_hash, b"\n")
+    )
 
 
 def join_annotated_commit_messages(messages: List[bytes]) -> bytes:
@@ -336,38 +399,96 @@ def try_parse_top_hash_from_message(message: bytes) -> Optional[CommitHash]:
     return try_parse_commit_hash_from_message(message, ANNOTATED_TOP_SUBDIR)
 
 
+@lru_cache(maxsize=None)
+def hash_annotation_regex(subdir: bytes) -> "re.Pattern[bytes]":
+    return re.compile(rb"^\^-- " + re.escape(subdir) + rb" ([0-9a-f]+)$", re.MULTILINE)
+
+
 def try_parse_commit_hash_from_message(
     message: bytes, subdir: bytes
 ) -> Optional[CommitHash]:
-    hash_annotation_regex = rb"^\^-- %s ([0-9a-f]+)$" % subdir
-    matches = list(re.finditer(hash_annotation_regex, message, re.MULTILINE))
-    if len(matches) == 0:
+    if b"^-- " + subdir + b" " not in message:
+        # Fast path, a substring search is much faster than the regex.
+        return None
+    regex = hash_annotation_regex(subdir)
+    match = regex.search(message)
+    if match is None:
         return None
-    elif len(matches) > 1:
+    if regex.search(message, match.end()) is not None:
         raise ValueError(
             f"Multiple hashes found for '{subdir.decode()}' in the message '{message.decode()}'"
         )
-    else:
-        (match,) = matches
     top_commit_hash = match.group(1)
     return top_commit_hash
 
 
+topic_regex = re.compile(rb"^Topic: (.+)$", re.MULTILINE)
+
+
 def try_get_topic_from_message(message: bytes) -> Optional[str]:
-    message_str = message.decode("utf-8")
-    topic_regex = r"^Topic: (.+)$"
-    matches = list(re.finditer(topic_regex, message_str, re.MULTILINE))
-    if len(matches) == 0:
+    if b"Topic: " not in message:
+        # Fast path, a substring search is much faster than the regex.
         return None
-    if len(matches) > 1:
+    match = topic_regex.search(message)
+    if match is None:
+        return None
+    if topic_regex.search(message, match.end()) is not None:
         raise ValueError(
-            f"Expected a single footer 'Topic: <topic>' in the message\n{message_str}"
+            f"Expected a single footer 'Topic: <topic>' in the message\n{message.decode()}"
         )
-    (match,) = matches
-    topic = match.group(1)
+    topic = match.group(1).decode("utf-8")
     return topic
 
 
+def format_cmdline(args: List[str]) -> str:
+    """Formats a command line for logging, quoted for the current platform."""
+    if os.name == "nt":
+        return subprocess.list2cmdline(args)
+    return shlex.join(args)
+
+
+def git_output(repo: Optional[Path], args: List[str], **kwargs) -> str:
+    """Runs git for the correct repo and returns stdout decoded as UTF-8.
+
+    Decoding once avoids the newline translation of text=True and the locale
+    dependent encoding on Windows.
+    """
+    full_args: List[str]
+    if repo is None:
+        full_args = ["git"] + args
+    else:
+        full_args = ["git", "-C", str(repo)] + args
+    return subprocess.check_output(full_args, **kwargs).decode("utf-8")
+
+
+def git_output_records(
+    repo: Path, args: List[str], separator: bytes, chunk_size: int = 1 << 20
+) -> Generator[bytes, None, None]:
+    """Runs git and yields stdout split on separator while it is produced.
+
+    This avoids buffering all of e.g. `git log` in memory at once.
+    """
+    process = subprocess.Popen(
+        ["git", "-C", str(repo)] + args,
+        stdout=subprocess.PIPE,
+    )
+    assert process.stdout is not None
+    try:
+        buffer = b""
+        for chunk in iter(partial(process.stdout.read, chunk_size), b""):
+            buffer += chunk
+            records = buffer.split(separator)
+            buffer = records.pop()
+            yield from records
+        if buffer != b"":
+            yield buffer
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, process.args)
+
+
 def log_run_git(
     repo: Optional[Path],
     args: List[str],
@@ -383,29 +504,18 @@ def log_run_git(
         full_args = ["git"] + args
     else:
         full_args = ["git", "-C", str(repo)] + args
-    cmdline = subprocess.list2cmdline(full_args)
     if dry_run:
-        print(f"\rWould run  {cmdline}", file=sys.stderr)
+        print(f"\rWould run  {format_cmdline(full_args)}", file=sys.stderr)
         ret = None
     else:
         if log_command:
-            print(f"\rRunning   {cmdline}", file=sys.stderr)
+            print(f"\rRunning   {format_cmdline(full_args)}", file=sys.stderr)
         ret = subprocess.run(full_args, check=check, **kwargs)
     return ret
 
 
 def ref_exists(repo: Repo, ref: str) -> bool:
-    result = subprocess.run(
-        ["git", "-C", str(repo.path)]
-        + ["rev-parse", "--verify", "--quiet", ref + "^{commit}"],
-        check=False,
-        stdout=subprocess.DEVNULL,
-    )
-    if result.returncode == 1:
-        return False
-    else:
-        result.check_returncode()
-        return True
+    return repo.cat_file.resolve(ref + "^{commit}") is not None
 
 
 def delete_refs(repo: Repo, refs: Iterable[RefStr]) -> None:
@@ -419,18 +529,11 @@ def delete_refs(repo: Repo, refs: Iterable[RefStr]) -> None:
 
 
 def get_remote_origin_refs(repo: Repo) -> List[RefStr]:
-    show_ref_stdout = subprocess.check_output(
-        ["git", "-C", str(repo.path), "show-ref"],
-        text=True,
+    # Let git filter the refs and skip the unused commit hashes.
+    for_each_ref_stdout = git_output(
+        repo.path, ["for-each-ref", "--format=%(refname)", "refs/remotes/origin/"]
     )
-    origin_ref_prefix = "refs/remotes/origin/"
-    remote_origin_refs: List[str] = []
-    for line in show_ref_stdout.splitlines(keepends=False):
-        # <commit-hash> SP <ref> LF
-        _, ref = line.strip().split(" ", 1)
-        if ref.startswith(origin_ref_prefix):
-            remote_origin_refs.append(ref)
-    return remote_origin_refs
+    return for_each_ref_stdout.splitlines(keepends=False)
 
 
 IgnoredCommits = Dict[RawUrl, Set[CommitHash]]
@@ -442,6 +545,8 @@ class ConfigParsingError(RuntimeError):
 
 @dataclass(frozen=True)
 class RepoConfig:
+    __slots__ = ("name", "enabled", "raw_urls", "fetch_url", "fetch_args", "push_url")
+
     name: RepoName
     """Name of the storage directory and used for pattern matching."""
     enabled: bool
@@ -475,8 +580,10 @@ class ConfigDict(DefaultDict[str, List[str]]):
     def parse(config_lines: str) -> "ConfigDict":
         ret = ConfigDict()
         for line in config_lines.splitlines(keepends=False):
-            key, value = line.split("=", 1)
-            ret[key].append(value)
+            # A key without '=' is a boolean without value, e.g. `[core] bare`.
+            key, _, value = line.partition("=")
+            # The same few keys are repeated in every config and .gitmodules file.
+            ret[sys.intern(key)].append(value)
         return ret
 
     @staticmethod
@@ -484,7 +591,11 @@ class ConfigDict(DefaultDict[str, List[str]]):
         ret = ConfigDict()
         for config_dict in config_dicts:
             for key, values in config_dict.items():
-                ret[key].extend(values)
+                existing_values = ret.get(key)
+                if existing_values is None:
+                    ret[key] = values.copy()
+                else:
+                    existing_values.extend(values)
         return ret
 
     def extract_mapping(self, prefix: str) -> Dict[str, "ConfigDict"]:
@@ -514,6 +625,101 @@ class ConfigDict(DefaultDict[str, List[str]]):
         return values[0]
 
 
+GitConfigEntry = Tuple[str, Optional[str]]
+"""A key and value pair, value is None for a key without '='."""
+
+git_config_section_regex = re.compile(
+    r'\[([0-9A-Za-z.-]+)(?:[ \t\v\f\r]+"((?:[^"\\]|\\.)*)")?\]'
+)
+git_config_key_regex = re.compile(r"([A-Za-z][0-9A-Za-z-]*)[ \t]*(=?)")
+git_config_escapes = {"t": "\t", "b": "\b", "n": "\n", "\\": "\\", '"': '"'}
+
+
+def parse_git_config_content(content: str) -> Optional[List[GitConfigEntry]]:
+    """Parses a git config file the same way as `git config --file - --list`.
+
+    Returns None for syntax which is not supported, e.g. continuation lines,
+    tabs inside values or keys on the same line as the section header.
+    Let git itself handle these corner cases and report syntax errors.
+    """
+    entries: List[GitConfigEntry] = []
+    section: Optional[str] = None
+    for line in content.split("\n"):
+        line = line.lstrip(" \t\v\f\r")
+        if line == "" or line[0] in "#;":
+            continue
+        if line[0] == "[":
+            match = git_config_section_regex.match(line)
+            if match is None:
+                return None
+            rest = line[match.end() :].lstrip(" \t\v\f\r")
+            if rest != "" and rest[0] not in "#;":
+                return None
+            section = match.group(1).lower()
+            subsection = match.group(2)
+            if subsection is not None:
+                section += "." + re.sub(r"\\(.)", r"\1", subsection)
+            continue
+        match = git_config_key_regex.match(line)
+        if match is None or section is None:
+            return None
+        key = f"{section}.{match.group(1).lower()}"
+        rest = line[match.end() :]
+        if match.group(2) == "":
+            # A boolean key without any value.
+            if rest.rstrip("\r") != "":
+                return None
+            entries.append((key, None))
+            continue
+        value = parse_git_config_value(rest)
+        if value is None:
+            return None
+        entries.append((key, value))
+    return entries
+
+
+def parse_git_config_value(text: str) -> Optional[str]:
+    """Parses the value part of a 'key = value' line in a git config file."""
+    value: List[str] = []
+    quote = False
+    spaces = ""
+    idx = 0
+    while idx < len(text):
+        c = text[idx]
+        idx += 1
+        if not quote:
+            if c in " \t\v\f\r":
+                # Trailing whitespace is dropped, leading is ignored.
+                if len(value) != 0:
+                    spaces += c
+                continue
+            if c in "#;":
+                # Comment.
+                break
+        if spaces != "":
+            if spaces.strip(" ") != "":
+                # Git versions differ in how to handle e.g. tabs.
+                return None
+            value.append(spaces)
+            spaces = ""
+        if c == "\\":
+            if idx == len(text):
+                # Continuation line, not supported.
+                return None
+            c = git_config_escapes.get(text[idx], "")
+            idx += 1
+            if c == "":
+                return None
+            value.append(c)
+        elif c == '"':
+            quote = not quote
+        else:
+            value.append(c)
+    if quote:
+        return None
+    return "".join(value)
+
+
 class ConfigLoader(ABC):
     def fetch_remote_config(self) -> None:
         pass
@@ -526,13 +732,43 @@ class ConfigLoader(ABC):
         return ConfigDict.parse(self.git_config_list())
 
 
+def run_concurrently(tasks: List[Callable[[], Any]], jobs: int = 8) -> None:
+    """Runs IO bound tasks, e.g. git network operations, in parallel."""
+    if len(tasks) <= 1 or jobs <= 1:
+        for task in tasks:
+            task()
+        return
+    with ThreadPoolExecutor(max_workers=min(jobs, len(tasks))) as executor:
+        futures = [executor.submit(task) for task in tasks]
+    for future in futures:
+        # Propagate any exception.
+        future.result()
+
+
+def fetch_remote_configs(config_loaders: List[ConfigLoader]) -> None:
+    """Fetches the remote configurations in parallel as it is IO bound.
+
+    Git configurations from the same remote are fetched with a single git-fetch.
+    """
+    tasks: List[Callable[[], Any]] = []
+    remote_to_git_loaders: Dict[Tuple[Path, Url], List["GitRemoteConfigLoader"]] = {}
+    for config_loader in config_loaders:
+        if isinstance(config_loader, GitRemoteConfigLoader):
+            remote = (config_loader.local_repo.path, config_loader.url)
+            remote_to_git_loaders.setdefault(remote, []).append(config_loader)
+        else:
+            tasks.append(config_loader.fetch_remote_config)
+    for git_loaders in remote_to_git_loaders.values():
+        tasks.append(partial(GitRemoteConfigLoader.fetch_together, git_loaders))
+    run_concurrently(tasks)
+
+
 class MultiConfigLoader(ConfigLoader):
     def __init__(self, config_loaders: List[ConfigLoader]):
         self.config_loaders: List[ConfigLoader] = config_loaders
 
     def fetch_remote_config(self) -> None:
-        for config_loader in self.config_loaders:
-            config_loader.fetch_remote_config()
+        fetch_remote_configs(self.config_loaders)
 
     def git_config_list(self) -> str:
         parts = []
@@ -545,6 +781,16 @@ class MultiConfigLoader(ConfigLoader):
         parts.reverse()
         return "".join(parts)
 
+    def get_config_dict(self) -> ConfigDict:
+        # Same as parsing git_config_list(), but lets the loaders reuse
+        # already parsed configurations.
+        config_dicts = [
+            config_loader.get_config_dict() for config_loader in self.config_loaders
+        ]
+        # The first part should override everything else.
+        config_dicts.reverse()
+        return ConfigDict.join(config_dicts)
+
 
 class LocalGitConfigLoader(ConfigLoader):
     """Loads configuration from a file on disk."""
@@ -553,13 +799,25 @@ class LocalGitConfigLoader(ConfigLoader):
         self.repo = repo
 
     def git_config_list(self) -> str:
-        return subprocess.check_output(
-            ["git", "-C", str(self.repo.path), "config", "--list"],
+        return git_output(
+            self.repo.path,
+            ["config", "--list"],
             env=os.environ,  # To make monkeypatching work for tests.
-            text=True,
         )
 
 
+class MonoRepoGitConfigLoader(LocalGitConfigLoader):
+    """Reuses the git configuration that MonoRepo has already read."""
+
+    repo: MonoRepo
+
+    def __init__(self, monorepo: MonoRepo):
+        super().__init__(monorepo)
+
+    def get_config_dict(self) -> ConfigDict:
+        return self.repo.git_config
+
+
 class ContentConfigLoader(ConfigLoader):
     @abstractmethod
     def read_config_file_content(self) -> str:
@@ -567,10 +825,32 @@ class ContentConfigLoader(ConfigLoader):
 
     def git_config_list(self) -> str:
         config_file_content = self.read_config_file_content()
-        return subprocess.check_output(
-            ["git", "config", "--file", "-", "--list"],
-            input=config_file_content,
-            text=True,
+        # Avoid spawning git for the common case.
+        entries = parse_git_config_content(config_file_content)
+        if entries is not None:
+            return "".join(
+                f"{key}\n" if value is None else f"{key}={value}\n"
+                for key, value in entries
+            )
+        return self.git_config_list_using_git(config_file_content)
+
+    def get_config_dict(self) -> ConfigDict:
+        config_file_content = self.read_config_file_content()
+        entries = parse_git_config_content(config_file_content)
+        if entries is None:
+            return ConfigDict.parse(self.git_config_list_using_git(config_file_content))
+        # Skip formatting and parsing git_config_list() for the common case.
+        ret = ConfigDict()
+        for key, value in entries:
+            ret[sys.intern(key)].append("" if value is None else value)
+        return ret
+
+    @staticmethod
+    def git_config_list_using_git(config_file_content: str) -> str:
+        return git_output(
+            None,
+            ["config", "--file", "-", "--list"],
+            input=config_file_content.encode("utf-8"),
         )
 
 
@@ -591,9 +871,12 @@ class LocalFileConfigLoader(ContentConfigLoader):
         pass
 
     def read_config_file_content(self) -> str:
-        if self.allow_missing and not self.filename.exists():
-            return ""
-        return self.filename.read_text(encoding="utf-8")
+        try:
+            return self.filename.read_text(encoding="utf-8")
+        except FileNotFoundError:
+            if self.allow_missing:
+                return ""
+            raise
 
 
 class GitRemoteConfigLoader(ContentConfigLoader):
@@ -612,19 +895,31 @@ class GitRemoteConfigLoader(ContentConfigLoader):
         self.local_ref = local_ref
 
     def fetch_remote_config(self) -> None:
+        GitRemoteConfigLoader.fetch_together([self])
+
+    @staticmethod
+    def fetch_together(config_loaders: List["GitRemoteConfigLoader"]) -> None:
+        """Fetches the refs of loaders sharing local_repo and url at once."""
+        first = config_loaders[0]
+        refspecs = {
+            f"+{config_loader.remote_ref}:{config_loader.local_ref}": None
+            for config_loader in config_loaders
+        }
         log_run_git(
-            self.local_repo.path,
-            ["fetch", "--quiet", self.url, f"+{self.remote_ref}:{self.local_ref}"],
+            first.local_repo.path,
+            ["fetch", "--quiet", first.url] + list(refspecs),
             stdout=sys.__stderr__.fileno(),
             stderr=subprocess.STDOUT,
         )
 
     def read_config_file_content(self) -> str:
-        return subprocess.check_output(
-            ["git", "-C", str(self.local_repo.path)]
-            + ["show", f"{self.local_ref}:{self.filename.as_posix()}"],
-            text=True,
-        )
+        object_name = f"{self.local_ref}:{self.filename.as_posix()}"
+        content = self.local_repo.cat_file.read(object_name)
+        if content is None:
+            raise ConfigParsingError(
+                f"{object_name} is missing in {self.local_repo.path}"
+            )
+        return content.decode("utf-8")
 
 
 class ConfigAccumulator:
@@ -635,6 +930,9 @@ class ConfigAccumulator:
     def try_load_main_config(self) -> Optional[ConfigDict]:
         try:
             return self.load_main_config()
+        except ConfigParsingError as err:
+            print(f"ERROR: Could not load the configuration: {err}")
+            return None
         except RuntimeError as err:
             print(f"ERROR: Could not find configuration location: {err}")
             return None
@@ -643,7 +941,7 @@ class ConfigAccumulator:
         """Load from the remote unless specified in .git/config."""
         config_loader = MultiConfigLoader(
             [
-                LocalGitConfigLoader(self.monorepo),
+                MonoRepoGitConfigLoader(self.monorepo),
                 StaticContentConfigLoader(
                     """\
 [toprepo.config.default]
@@ -658,19 +956,26 @@ class ConfigAccumulator:
         return self.load_config(config_loader)
 
     def load_config(self, config_loader: ConfigLoader) -> ConfigDict:
-        full_config_dict = ConfigDict()
+        loaded_config_dicts: List[ConfigDict] = []
+        # Only the toprepo.config.* part of the already loaded configs is needed
+        # to resolve the sub-config-loaders, so avoid joining everything in
+        # every iteration.
+        loader_overrides = ConfigDict()
         existing_names = set()
-        config_loaders_todo = [config_loader]
+        if self.online:
+            config_loader.fetch_remote_config()
+        config_loaders_todo = deque([config_loader])
         while len(config_loaders_todo) != 0:
-            config_loader = config_loaders_todo.pop(0)
-            if self.online:
-                config_loader.fetch_remote_config()
+            config_loader = config_loaders_todo.popleft()
             current_config_dict = config_loader.get_config_dict()
             sub_config_loaders = self.get_config_loaders(
-                current_config_dict, full_config_dict
+                current_config_dict, loader_overrides
             )
+            loaded_config_dicts.append(current_config_dict)
             # Earlier loaded configs overrides later loaded configs.
-            full_config_dict = ConfigDict.join([current_config_dict, full_config_dict])
+            for key, values in current_config_dict.items():
+                if key.startswith("toprepo.config."):
+                    loader_overrides[key] = values + loader_overrides.get(key, [])
             # Traverse into sub-config-loaders.
             for name, sub_config_loader in sub_config_loaders.items():
                 if name in existing_names:
@@ -679,7 +984,12 @@ class ConfigAccumulator:
                     )
                 existing_names.add(name)
                 config_loaders_todo.append(sub_config_loader)
-        return full_config_dict
+            if self.online:
+                # Fetch the siblings in parallel.
+                fetch_remote_configs(list(sub_config_loaders.values()))
+        # Earlier loaded configs overrides later loaded configs.
+        loaded_config_dicts.reverse()
+        return ConfigDict.join(loaded_config_dicts)
 
     def get_config_loaders(
         self, config_dict: ConfigDict, overrides: ConfigDict
@@ -687,9 +997,8 @@ class ConfigAccumulator:
         config_loaders: Dict[str, ConfigLoader] = {}
         # Accumulate toprepo.config.<id>.* keys.
         own_loader_config_dicts = config_dict.extract_mapping("toprepo.config")
-        full_loader_config_dicts = ConfigDict.join(
-            [config_dict, overrides]
-        ).extract_mapping("toprepo.config")
+        # Only join the toprepo.config keys, not the full configurations.
+        override_loader_config_dicts = overrides.extract_mapping("toprepo.config")
         for name, own_loader_values in own_loader_config_dicts.items():
             # Check if values are just for overriding or the actual configuration.
             partial_value = own_loader_values.get("partial", ["0"])
@@ -702,7 +1011,12 @@ class ConfigAccumulator:
             if is_partial:
                 continue
             # Actual configuration, load.
-            full_loader_values = full_loader_config_dicts[name]
+            full_loader_values = ConfigDict.join(
+                [
+                    own_loader_values,
+                    override_loader_config_dicts.get(name, ConfigDict()),
+                ]
+            )
             config_loaders[name] = self.get_config_loader(name, full_loader_values)
         return config_loaders
 
@@ -746,7 +1060,8 @@ def get_gitmodules_info(
 
     configs: Dict[PurePosixPath, GitModuleInfo] = {}
     for name, config_dict in submod_config_mapping.items():
-        raw_url: RawUrl = config_dict.get_singleton("url")
+        # The same URLs are parsed from .gitmodules in every commit, share them.
+        raw_url: RawUrl = sys.intern(config_dict.get_singleton("url"))
         resolved_url = join_submodule_url(parent_url, raw_url)
         submod_info = GitModuleInfo(
             name=name,
@@ -762,7 +1077,8 @@ def get_gitmodules_info(
     return list(configs.values())
 
 
-@dataclass(frozen=True)
+# eq=False to hash by identity, the fields are not hashable.
+@dataclass(frozen=True, eq=False)
 class Config:
     missing_commits: IgnoredCommits
     """Ignored because they are missing.
@@ -775,13 +1091,17 @@ class Config:
 
     repos: List[RepoConfig]
 
+    @cached_property
+    def repos_by_name(self) -> Dict[RepoName, RepoConfig]:
+        return {repo_config.name: repo_config for repo_config in self.repos}
+
     @cached_property
     def raw_url_to_repos(self) -> Dict[RawUrl, List[RepoConfig]]:
         # Map URL to RepoConfig.
-        raw_url_to_repos: DefaultDict[RawUrl, List[RepoConfig]] = defaultdict(list)
+        raw_url_to_repos: Dict[RawUrl, List[RepoConfig]] = {}
         for repo_config in self.repos:
             for raw_url in repo_config.raw_urls:
-                raw_url_to_repos[raw_url].append(repo_config)
+                raw_url_to_repos.setdefault(sys.intern(raw_url), []).append(repo_config)
         return raw_url_to_repos
 
     @staticmethod
@@ -911,56 +1231,86 @@ class Config:
     def repo_is_wanted(
         name: RepoName, wanted_repos_patterns: List[str]
     ) -> Optional[bool]:
-        wanted = None
         for pattern in wanted_repos_patterns:
             if pattern[0] not in "+-":
                 raise ConfigParsingError(
                     f"Invalid wanted repo config {pattern} for {name}, "
                     + "should start with '+' or '-' followed by a regex."
                 )
-            try:
-                if re.fullmatch(pattern[1:], name) is not None:
-                    wanted = pattern[0] == "+"
-            except RuntimeError as err:
-                raise ConfigParsingError(
-                    f"Invalid wanted repo regex {pattern[1:]} " + f"for {name}: {err}"
-                )
-        return wanted
+        try:
+            compiled_patterns = compile_wanted_repos_patterns(
+                tuple(wanted_repos_patterns)
+            )
+        except re.error as err:
+            raise ConfigParsingError(
+                f"Invalid wanted repo regex {err.pattern} " + f"for {name}: {err}"
+            )
+        # The last matching pattern wins.
+        for wanted, regex in reversed(compiled_patterns):
+            if regex.fullmatch(name) is not None:
+                return wanted
+        return None
 
 
-def remote_to_repo(
-    remote: str, git_modules: List[GitModuleInfo], config: Config
-) -> Optional[Tuple[RepoName, Optional[GitModuleInfo]]]:
-    """Map a remote or URL to a repository.
+@lru_cache(maxsize=None)
+def compile_wanted_repos_patterns(
+    wanted_repos_patterns: Tuple[str, ...]
+) -> List[Tuple[bool, "re.Pattern[str]"]]:
+    """Compiles '+regex' and '-regex' into (wanted, compiled regex) pairs."""
+    return [
+        (pattern[0] == "+", re.compile(pattern[1:]))
+        for pattern in wanted_repos_patterns
+    ]
 
-    A repo can be specified by subrepo path inside the toprepo or
-    as a full or partial URL.
+
+@lru_cache(maxsize=8192)
+def partial_urls(url: str) -> Tuple[str, ...]:
+    """Returns the URL itself and the partial URLs that should also match it.
+
+    Example: ssh://user@github.com:22/foo/bar.git gives also
+    ssh://user@github.com:22/foo/bar, user@github.com:22/foo/bar,
+    github.com:22/foo/bar and foo/bar.
     """
-    # Map a full or partial URL or path to one or more repos.
-    remote_to_name: DefaultDict[str, Set[Tuple[RepoName, Optional[GitModuleInfo]]]] = (
-        defaultdict(set)
-    )
+    ret = [url]
+    if url.endswith(".git"):
+        url = url[: -len(".git")]
+    ret.append(url)
+    # Scan with a start index and only slice out the partial URLs.
+    start = 0
+    idx = url.find("://")
+    if idx != -1:
+        start = idx + 3
+        ret.append(url[start:])
+    idx = url.find("@", start)
+    if idx != -1:
+        start = idx + 1
+        ret.append(url[start:])
+    idx = url.find("/", start)
+    if idx != -1 and not url.startswith(".", start):
+        ret.append(url[idx + 1 :])
+    return tuple(ret)
+
+
+RemoteEntry = Tuple[RepoName, Optional[GitModuleInfo]]
+RemoteIndex = Dict[str, Tuple[RemoteEntry, ...]]
+
+
+@lru_cache(maxsize=4)
+def build_remote_index(
+    config: "Config", git_modules: Tuple[GitModuleInfo, ...]
+) -> RemoteIndex:
+    """Maps full or partial URLs and paths to one or more repos."""
+    # Ordered sets, i.e. dicts with None values, turned into tuples at the end.
+    remote_to_name: DefaultDict[str, Dict[RemoteEntry, None]] = defaultdict(dict)
 
     def add_url(url: str, name: RepoName, gitmod: Optional[GitModuleInfo]):
         entry = (name, gitmod)
-        remote_to_name[url].add(entry)
-        # Also match partial URLs.
-        # Example: ssh://user@github.com:22/foo/bar.git
-        url = removesuffix(url, ".git")
-        remote_to_name[url].add(entry)
-        if "://" in url:
-            _, url = url.split("://", 1)
-            remote_to_name[url].add(entry)
-        if "@" in url:
-            _, url = url.split("@", 1)
-            remote_to_name[url].add(entry)
-        if "/" in url and not url.startswith("."):
-            _, url = url.split("/", 1)
-            remote_to_name[url].add(entry)
-
-    remote_to_name["origin"].add((TopRepo.name, None))
-    remote_to_name["."].add((TopRepo.name, None))
-    remote_to_name[""].add((TopRepo.name, None))
+        for partial_url in partial_urls(url):
+            remote_to_name[partial_url][entry] = None
+
+    remote_to_name["origin"][(TopRepo.name, None)] = None
+    remote_to_name["."][(TopRepo.name, None)] = None
+    remote_to_name[""][(TopRepo.name, None)] = None
     add_url(config.top_fetch_url, TopRepo.name, None)
     add_url(config.top_push_url, TopRepo.name, None)
 
@@ -970,13 +1320,29 @@ def remote_to_repo(
             # Add URLs from .gitmodules.
             add_url(mod.url, cfg.name, mod)
             add_url(mod.raw_url, cfg.name, mod)
-            remote_to_name[mod.name].add((cfg.name, mod))
-            remote_to_name[str(mod.path)].add((cfg.name, mod))
+            remote_to_name[mod.name][(cfg.name, mod)] = None
+            remote_to_name[str(mod.path)][(cfg.name, mod)] = None
             # Add URLs from the toprepo config.
             add_url(cfg.fetch_url, cfg.name, mod)
             add_url(cfg.push_url, cfg.name, mod)
             for raw_url in cfg.raw_urls:
                 add_url(raw_url, cfg.name, mod)
+    # Most keys map to a single entry, a tuple is much smaller than a set.
+    return {url: tuple(entries) for url, entries in remote_to_name.items()}
+
+
+def remote_to_repo(
+    remote: str, git_modules: List[GitModuleInfo], config: Config
+) -> Optional[Tuple[RepoName, Optional[GitModuleInfo]]]:
+    """Map a remote or URL to a repository.
+
+    A repo can be specified by subrepo path inside the toprepo or
+    as a full or partial URL.
+    """
+    if remote in ("origin", ".", ""):
+        # The common case, no need to index all the submodules.
+        return (TopRepo.name, None)
+    remote_to_name = build_remote_index(config, tuple(git_modules))
 
     # Now, try to find our repo.
     full_remote = remote
@@ -997,10 +1363,20 @@ def remote_to_repo(
         print("Is .gitmodules missing?")
         return None
     if len(entries) > 1:
-        names_str = ", ".join(sorted(name for name, _ in entries))
-        print(f"ERROR: Multiple remote candidates: {names_str}")
+        # The same repo can be reached through several submodules,
+        # so list the submodule paths too.
+        name_to_paths: Dict[RepoName, List[str]] = {}
+        for name, gitmod in entries:
+            paths = name_to_paths.setdefault(name, [])
+            if gitmod is not None:
+                paths.append(f"{gitmod.path}/")
+        candidates_str = ", ".join(
+            f"{name} (at {', '.join(sorted(paths))})" if paths else name
+            for name, paths in sorted(name_to_paths.items())
+        )
+        print(f"ERROR: Multiple remote candidates: {candidates_str}")
         return None
-    ((name, gitmod),) = list(entries)
+    ((name, gitmod),) = entries
     return (name, gitmod)
 
 
@@ -1021,16 +1397,40 @@ def clone_commit(commit: git_filter_repo.Commit) -> git_filter_repo.Commit:
 
 def clone_file_change(
     file_change: git_filter_repo.FileChange,
+    filename: bytes,
 ) -> git_filter_repo.FileChange:
-    # FileChange.__init__() does some processing, avoid that.
-    ret = git_filter_repo.FileChange(b"M", b"n/a", -1, b"100644")
-    ret.type = file_change.type
-    ret.filename = file_change.filename
-    ret.mode = file_change.mode
-    ret.blob_id = file_change.blob_id
+    """Returns a copy of file_change at a new path.
+
+    A shallow copy avoids the processing in FileChange.__init__().
+    """
+    ret = copy.copy(file_change)
+    ret.filename = filename
     return ret
 
 
+def get_containing_subdir(path: bytes, subdirs: Container[bytes]) -> Optional[bytes]:
+    """Returns the entry in subdirs that path is located in, if any.
+
+    Only the parent directories of path are looked up, so the cost does not
+    depend on the number of subdirs.
+    """
+    while True:
+        path, sep, _ = path.rpartition(b"/")
+        if not sep:
+            return None
+        if path in subdirs:
+            return path
+
+
+def depth_priority(depth: int, order: int) -> int:
+    """Returns a heapq priority which pops the deepest commit first.
+
+    Ties are broken by `order`, which must be unique and fit in 32 bits, so
+    that the commits themselves never need to be compared.
+    """
+    return (-depth << 32) | order
+
+
 class DevNullWriter:
     def write(self, _: Any) -> None:
         pass
@@ -1075,25 +1475,31 @@ class CommitMap:
         return ret
 
     @staticmethod
-    def collect_tree_hashes(repo: Repo) -> Dict[CommitHash, TreeHash]:
-        """Get all commit hashes and map to tree hashes in a repo."""
+    def collect_tree_hashes(
+        repo: Repo, refs: List[RefStr]
+    ) -> Dict[CommitHash, TreeHash]:
+        """Get the commit hashes reachable from refs and map to tree hashes."""
         log_stdout = subprocess.check_output(
-            ["git", "-C", str(repo.path)] + ["log", "--format=%H %T", "--all", "--"]
+            ["git", "-C", str(repo.path)] + ["log", "--format=%H %T"] + refs + ["--"]
         )
-        commit_to_tree: Dict[CommitHash, TreeHash] = {}
-        for line in log_stdout.splitlines(keepends=False):
-            commit_hash, tree_hash = line.split(b" ", 1)
-            commit_to_tree[commit_hash] = tree_hash
+        # <commit-hash> SP <tree-hash> LF, i.e. alternating commit and tree
+        # hashes when splitting on whitespace.
+        hashes = iter(log_stdout.split())
+        commit_to_tree: Dict[CommitHash, TreeHash] = dict(zip(hashes, hashes))
         return commit_to_tree
 
     @staticmethod
     def collect_commits(
-        repo: Union[SubRepo, MonoRepo], refs: List[RefStr]
+        repo: Union[SubRepo, MonoRepo],
+        refs: List[RefStr],
+        commit_to_tree: Optional[Dict[CommitHash, TreeHash]] = None,
     ) -> "CommitMap":
         """Loads metadata about all commits."""
         print(f"Collecting metadata for {repo.name}...")
         ret = CommitMap()
-        commit_to_tree = ret.collect_tree_hashes(repo)
+        if commit_to_tree is None:
+            # Only walk the same history as git-filter-repo will.
+            commit_to_tree = ret.collect_tree_hashes(repo, refs)
 
         args = git_filter_repo.FilteringOptions.parse_args(
             ["--partial", "--refs", "dummy"]
@@ -1110,25 +1516,62 @@ class CommitMap:
         repo_filter.run()
         return ret
 
+    @staticmethod
+    def collect_commits_in_repos(
+        repos: List[SubRepo], refs: List[RefStr], jobs: int = 8
+    ) -> Dict[RepoName, "CommitMap"]:
+        """Loads metadata about all commits in multiple repositories.
+
+        git-filter-repo allocates ids from a global counter, so the histories
+        are parsed one at a time. Listing the tree hashes only runs git and is
+        done in parallel meanwhile, for at most `jobs` repositories ahead as
+        every listing holds a commit to tree map for the full history.
+        """
+        if len(repos) == 0:
+            return {}
+        jobs = max(jobs, 1)
+        ret: Dict[RepoName, CommitMap] = {}
+        with ThreadPoolExecutor(max_workers=min(jobs, len(repos))) as executor:
+            repos_to_list = iter(repos)
+            tree_hash_futures = deque(
+                executor.submit(CommitMap.collect_tree_hashes, repo, refs)
+                for repo in itertools.islice(repos_to_list, jobs)
+            )
+            for repo in repos:
+                commit_to_tree = tree_hash_futures.popleft().result()
+                next_repo = next(repos_to_list, None)
+                if next_repo is not None:
+                    tree_hash_futures.append(
+                        executor.submit(CommitMap.collect_tree_hashes, next_repo, refs)
+                    )
+                ret[repo.config.name] = CommitMap.collect_commits(
+                    repo, refs, commit_to_tree
+                )
+                del commit_to_tree
+        return ret
+
     def _collect_commit_callback(
         self, commit_to_tree: Dict[CommitHash, TreeHash], commit, metadata
     ):
         _ = metadata
-        commit.depth = 1 + max(
-            (
-                self.id_to_commit[parent_id].depth
-                for parent_id in commit.parents
-                if isinstance(parent_id, int)
-            ),
-            default=0,
-        )
+        # A plain loop avoids creating a generator for every commit.
+        max_parent_depth = 0
+        for parent_id in commit.parents:
+            if isinstance(parent_id, int):
+                parent_depth = self.id_to_commit[parent_id].depth
+                if parent_depth > max_parent_depth:
+                    max_parent_depth = parent_depth
+        commit.depth = 1 + max_parent_depth
         self.id_to_commit[commit.id] = commit
         self.hash_to_commit[commit.original_id] = commit
-        commit.tree_hash = commit_to_tree[commit.original_id]
+        # Each commit is only visited once, release the memory on the way.
+        commit.tree_hash = commit_to_tree.pop(commit.original_id)
 
 
 @dataclass(frozen=True)
 class BumpInfo:
+    __slots__ = ("subrepo_commit", "first_mono_commit")
+
     subrepo_commit: git_filter_repo.Commit
     """The original commit from the sub repo."""
 
@@ -1142,6 +1585,25 @@ class BumpInfo:
     """
 
 
+def chain_bumps(
+    parent_bumps: Mapping[bytes, BumpInfo], subdir: bytes, bump: BumpInfo
+) -> Mapping[bytes, BumpInfo]:
+    """Returns parent_bumps with subdir set to bump, without modifying it.
+
+    Instead of copying all the bumps for every inserted subrepo commit,
+    a ChainMap layer is added on top of the parent. The chain is flattened
+    when it gets long to keep the lookups fast.
+    """
+    max_chain_length = 16
+    if isinstance(parent_bumps, ChainMap):
+        if len(parent_bumps.maps) < max_chain_length:
+            return parent_bumps.new_child({subdir: bump})
+        flattened = dict(parent_bumps)
+        flattened[subdir] = bump
+        return flattened
+    return ChainMap({subdir: bump}, parent_bumps)
+
+
 class SubmoduleFilterHelper:
     def __init__(self, source_repo: Repo, parent_url: Url):
         self.current_commit: Optional[git_filter_repo.Commit] = None
@@ -1182,15 +1644,23 @@ class SubmoduleFilterHelper:
     def _load_submodule_configs(
         self, commit_hash: CommitHash
     ) -> Dict[bytes, GitModuleInfo]:
+        gitmodules_content = GitRemoteConfigLoader(
+            url="",
+            remote_ref="",
+            filename=PurePosixPath(".gitmodules"),
+            local_repo=self.repo,
+            local_ref=commit_hash.decode("utf-8"),
+        ).read_config_file_content()
+        return self._parse_submodule_configs(gitmodules_content)
+
+    @lru_cache()
+    def _parse_submodule_configs(
+        self, gitmodules_content: str
+    ) -> Dict[bytes, GitModuleInfo]:
+        # Many commits on different branches share the same .gitmodules content,
+        # only parse each version once.
         gitmodules = get_gitmodules_info(
-            GitRemoteConfigLoader(
-                url="",
-                remote_ref="",
-                filename=PurePosixPath(".gitmodules"),
-                local_repo=self.repo,
-                local_ref=commit_hash.decode("utf-8"),
-            ),
-            self.parent_url,
+            StaticContentConfigLoader(gitmodules_content), self.parent_url
         )
         return {config.path.as_posix().encode("utf-8"): config for config in gitmodules}
 
@@ -1218,9 +1688,17 @@ class SubmoduleFilterHelper:
 
 
 class ReferencedSubmodCommitsCollector:
+    cache_filename = "toprepo-referenced-submodule-commits"
+    """Stored in the git dir of the top repo, see `load_cache`."""
+
+    max_excluded_tips = 1000
+    """Walk the full history rather than passing too many ^<tip> arguments."""
+
     def __init__(self, repo: TopRepo):
-        self.referenced_commits: DefaultDict[RawUrl, Set[CommitHash]] = defaultdict(set)
-        """Mapping from submodule URL to commit hashes."""
+        self.commit_to_submod_commits: Dict[
+            CommitHash, List[Tuple[RawUrl, CommitHash]]
+        ] = {}
+        """Mapping from a top commit to the submodule commits it references."""
 
         self.submodule_filter_helper = SubmoduleFilterHelper(
             repo, repo.config.fetch_url
@@ -1230,35 +1708,116 @@ class ReferencedSubmodCommitsCollector:
         _ = metadata
         self.submodule_filter_helper.commit_callback(commit)
         submods = self.submodule_filter_helper.get_submodules(commit)
+        submod_commits: List[Tuple[RawUrl, CommitHash]] = []
         for file_change, submodule_config in submods:
             if submodule_config is not None:
                 raw_url = submodule_config.raw_url
-                self.referenced_commits[raw_url].add(file_change.blob_id)
+                submod_commits.append((raw_url, file_change.blob_id))
+        self.commit_to_submod_commits[commit.original_id] = submod_commits
+
+    @staticmethod
+    def load_cache(
+        cache_file: Path,
+    ) -> Dict[CommitHash, List[Tuple[RawUrl, CommitHash]]]:
+        """Loads the result of earlier runs.
+
+        Each line is either '<top-commit>' for a commit without submodule
+        changes or '<top-commit> <submod-commit> <raw-url>'.
+        """
+        ret: Dict[CommitHash, List[Tuple[RawUrl, CommitHash]]] = {}
+        if not cache_file.exists():
+            return ret
+        for line in cache_file.read_bytes().splitlines():
+            parts = line.split(b" ", 2)
+            submod_commits = ret.setdefault(parts[0], [])
+            if len(parts) == 3:
+                submod_commits.append((parts[2].decode("utf-8"), parts[1]))
+        return ret
+
+    @staticmethod
+    def save_cache(
+        cache_file: Path,
+        commit_to_submod_commits: Dict[CommitHash, List[Tuple[RawUrl, CommitHash]]],
+    ) -> None:
+        lines: List[bytes] = []
+        for commit_hash, submod_commits in commit_to_submod_commits.items():
+            if len(submod_commits) == 0:
+                lines.append(commit_hash + b"\n")
+            for raw_url, submod_commit_hash in submod_commits:
+                lines.append(
+                    b"%s %s %s\n"
+                    % (commit_hash, submod_commit_hash, raw_url.encode("utf-8"))
+                )
+        tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+        tmp_file.write_bytes(b"".join(lines))
+        os.replace(tmp_file, cache_file)
 
     @staticmethod
     def collect(repo: TopRepo) -> Dict[str, Set[CommitHash]]:
         """Iterates through a repository and collects submodule commits.
 
+        Only commits that were not visited in an earlier run are traversed.
+
         Returns:
             A mapping from submodule URL to commit hashes.
         """
         collector = ReferencedSubmodCommitsCollector(repo)
+        cache_file = repo.git_dir / ReferencedSubmodCommitsCollector.cache_filename
 
-        args = git_filter_repo.FilteringOptions.parse_args(
-            ["--partial", "--refs", "dummy"]
-            + ["--source", str(repo.path)]
-            # --target must be the same as --source but is overridden later.
-            + ["--target", str(repo.path)]
+        # Forget about commits that are not reachable anymore.
+        rev_list_stdout = subprocess.check_output(
+            ["git", "-C", str(repo.path), "rev-list", "--all", "--parents"]
         )
-        args.refs = ["--all"]
-        repo_filter = git_filter_repo.RepoFilter(
-            args,
-            commit_callback=collector._commit_callback,
-        )
-        repo_filter.set_output(DevNullOutputRepoFilter())
-        repo_filter.run()
+        commit_to_parents: Dict[CommitHash, List[CommitHash]] = {}
+        for line in rev_list_stdout.splitlines():
+            commit_hash, *parents = line.split(b" ")
+            commit_to_parents[commit_hash] = parents
+        cached = ReferencedSubmodCommitsCollector.load_cache(cache_file)
+        collector.commit_to_submod_commits = {
+            commit_hash: submod_commits
+            for commit_hash, submod_commits in cached.items()
+            if commit_hash in commit_to_parents
+        }
 
-        return collector.referenced_commits
+        if len(collector.commit_to_submod_commits) != len(commit_to_parents):
+            # The cached commits are closed under ancestry, so excluding
+            # the cached commits without cached children excludes them all.
+            cached_parents = set(
+                parent
+                for commit_hash in collector.commit_to_submod_commits
+                for parent in commit_to_parents[commit_hash]
+            )
+            cached_tips = [
+                commit_hash
+                for commit_hash in collector.commit_to_submod_commits
+                if commit_hash not in cached_parents
+            ]
+            refs = ["--all"]
+            if len(cached_tips) <= ReferencedSubmodCommitsCollector.max_excluded_tips:
+                refs += [f"^{tip.decode('utf-8')}" for tip in cached_tips]
+
+            args = git_filter_repo.FilteringOptions.parse_args(
+                ["--partial", "--refs", "dummy"]
+                + ["--source", str(repo.path)]
+                # --target must be the same as --source but is overridden later.
+                + ["--target", str(repo.path)]
+            )
+            args.refs = refs
+            repo_filter = git_filter_repo.RepoFilter(
+                args,
+                commit_callback=collector._commit_callback,
+            )
+            repo_filter.set_output(DevNullOutputRepoFilter())
+            repo_filter.run()
+            ReferencedSubmodCommitsCollector.save_cache(
+                cache_file, collector.commit_to_submod_commits
+            )
+
+        referenced_commits: DefaultDict[RawUrl, Set[CommitHash]] = defaultdict(set)
+        for submod_commits in collector.commit_to_submod_commits.values():
+            for raw_url, submod_commit_hash in submod_commits:
+                referenced_commits[raw_url].add(submod_commit_hash)
+        return referenced_commits
 
 
 class RepoFetcher:
@@ -1284,6 +1843,22 @@ class RepoFetcher:
 
         All the blobs and trees need to be accessible within the monorepo.
         This filtering will copy all the data over."""
+        self._fetch_from_remote(repo, ref_args)
+        self._copy_to_monorepo(repo)
+
+    def fetch_repos(self, repos: List[SubRepo], jobs: int):
+        """Like `fetch_repo`, but fetches from the remotes in parallel."""
+        run_concurrently(
+            [partial(self._fetch_from_remote, repo, None) for repo in repos],
+            jobs=jobs,
+        )
+        # Writing to the monorepo concurrently might fail on locked refs.
+        for repo in repos:
+            self._copy_to_monorepo(repo)
+
+    def _fetch_from_remote(
+        self, repo: Union[TopRepo, SubRepo], ref_args: Optional[List[str]]
+    ):
         self.init_subrepo(repo)
         # First fetch into the individual repository.
         if ref_args is None:
@@ -1302,6 +1877,8 @@ class RepoFetcher:
             ["git", "-C", str(repo.path)]
             + ["config", "remote.origin.pushurl", repo.config.push_url]
         )
+
+    def _copy_to_monorepo(self, repo: Union[TopRepo, SubRepo]):
         # Then move the blobs over to the monorepo.
         # The toprepo itself can be moved by git-filter-repo,
         # but moving the content anyway because 'git-toprepo push' requires
@@ -1332,11 +1909,11 @@ class RepoExpanderBase:
         new_commit.parents = [
             subrepo_id_to_converted_id[pid] for pid in subrepo_commit.parents
         ]
-        new_commit.file_changes = list(
-            map(clone_file_change, subrepo_commit.file_changes)
-        )
-        for new_fc in new_commit.file_changes:
-            new_fc.filename = subdir + b"/" + new_fc.filename
+        path_prefix = subdir + b"/"
+        new_commit.file_changes = [
+            clone_file_change(fc, path_prefix + fc.filename)
+            for fc in subrepo_commit.file_changes
+        ]
         return new_commit
 
 
@@ -1363,10 +1940,12 @@ class TopRepoExpander(RepoExpanderBase):
         *,
         allow_fetching: bool,
         abort_on_missing: bool,
+        jobs: int = 8,
     ) -> bool:
         """Perform the monorepo expansion using git-filter-repo.
 
-        Submodules will be fetched and filtered on demand.
+        Submodules will be fetched and filtered on demand,
+        up to `jobs` in parallel.
         """
         old_toprepo_refs = set(get_remote_origin_refs(self.toprepo))
         print("Collecting referenced submodules...")
@@ -1375,10 +1954,11 @@ class TopRepoExpander(RepoExpanderBase):
         for subrepo in subrepos.values():
             self.fetcher.init_subrepo(subrepo)
         commit_map = self.make_commits_available(
-            sorted(subrepos.values(), key=lambda repo: repo.name),
+            subrepos,
             submod_commits,
             allow_fetching=allow_fetching,
             abort_on_missing=abort_on_missing,
+            jobs=jobs,
         )
         if commit_map is None:
             return False
@@ -1395,6 +1975,9 @@ class TopRepoExpander(RepoExpanderBase):
             + ["--target", str(self.monorepo.path)]
         )
         args.refs = top_refs
+        # The toprepo content has already been fetched into the monorepo by
+        # RepoFetcher.fetch_repo(), so let git-fast-export skip the blob data.
+        args.source_objects_in_target = True
         repo_filter = None
         repo_filter = git_filter_repo.RepoFilter(
             args,
@@ -1446,67 +2029,68 @@ class TopRepoExpander(RepoExpanderBase):
                 "INFO: Printed above is an example git-toprepo config "
                 + "to fix the warnings."
             )
-        return subrepos
+        return dict(sorted(subrepos.items()))
 
     def make_commits_available(
         self,
-        subrepos: List[SubRepo],
+        subrepos: Dict[RepoName, SubRepo],
         submod_commits: Dict[str, Set[CommitHash]],
         *,
         allow_fetching: bool,
         abort_on_missing: bool,
+        jobs: int = 8,
     ) -> Optional[CommitMap]:
         """Check that all wanted commits exists.
 
         If commits are missing, run git-fetch in all the sub repos
-        associated with that URL.
+        associated with that URL, up to `jobs` in parallel.
 
         Args:
+            subrepos: The enabled sub repos by name, in sorted order.
             submod_commits: A map from a raw URL to needed commit hashes.
         """
-        fetched_repos: Set[str] = set()  # subrepo.config.name
-        commit_maps = {
-            subrepo.config.name: CommitMap.collect_commits(subrepo, ["--all"])
-            for subrepo in subrepos
-        }
-        subrepo_map = {subrepo.config.name: subrepo for subrepo in subrepos}
-        missing_commits: List[Tuple[RawUrl, CommitHash]] = []
-
-        for url, referenced_commits in submod_commits.items():
-            subrepos = [
-                subrepo_map[subrepo_config.name]
+        commit_maps = CommitMap.collect_commits_in_repos(
+            list(subrepos.values()), ["--all"], jobs=jobs
+        )
+        url_to_subrepos: Dict[RawUrl, List[SubRepo]] = {}
+        for url in submod_commits.keys():
+            url_subrepos = [
+                subrepos[subrepo_config.name]
                 for subrepo_config in self.config.raw_url_to_repos.get(url, [])
                 if subrepo_config.enabled
             ]
-            if len(subrepos) == 0:
-                continue
-
-            def get_commits_to_fetch() -> Set[CommitHash]:
-                """Finds what commits need to be fetched from upstream."""
-                ret: Set[CommitHash] = (
-                    referenced_commits - self.config.missing_commits.get(url, set())
+            if len(url_subrepos) != 0:
+                url_to_subrepos[url] = url_subrepos
+
+        def get_commits_to_fetch(url: RawUrl) -> Set[CommitHash]:
+            """Finds what commits need to be fetched from upstream."""
+            referenced_commits = submod_commits[url]
+            ret: Set[CommitHash] = referenced_commits - self.config.missing_commits.get(
+                url, set()
+            )
+            for subrepo in url_to_subrepos[url]:
+                ret.difference_update(
+                    commit_maps[subrepo.config.name].hash_to_commit.keys()
                 )
-                for subrepo in subrepos:
-                    ret.difference_update(
-                        commit_maps[subrepo.config.name].hash_to_commit.keys()
-                    )
-                return ret
-
-            commits_to_fetch = get_commits_to_fetch()
-            # Fetch.
-            if len(commits_to_fetch) != 0 and allow_fetching:
-                for subrepo in subrepos:
-                    if subrepo.config.name not in fetched_repos:
-                        fetched_repos.add(subrepo.config.name)
-                        self.fetcher.fetch_repo(subrepo)
-                        commit_maps[subrepo.config.name] = CommitMap.collect_commits(
-                            subrepo,
-                            ["--all"],
-                        )
-                # Recalculate.
-                commits_to_fetch = get_commits_to_fetch()
-            # Check.
-            for commit_hash in sorted(commits_to_fetch):
+            return ret
+
+        # Fetch all the sub repos that lack any commit at once.
+        if allow_fetching:
+            repos_to_fetch: Dict[RepoName, SubRepo] = {}
+            for url, url_subrepos in url_to_subrepos.items():
+                if len(get_commits_to_fetch(url)) != 0:
+                    for subrepo in url_subrepos:
+                        repos_to_fetch[subrepo.config.name] = subrepo
+            fetched_repos = list(repos_to_fetch.values())
+            self.fetcher.fetch_repos(fetched_repos, jobs=jobs)
+            commit_maps.update(
+                CommitMap.collect_commits_in_repos(fetched_repos, ["--all"], jobs=jobs)
+            )
+
+        # Check.
+        missing_commits: List[Tuple[RawUrl, CommitHash]] = []
+        for url in url_to_subrepos.keys():
+            for commit_hash in sorted(get_commits_to_fetch(url)):
                 missing_commits.append((url, commit_hash))
 
         if len(missing_commits) != 0:
@@ -1603,10 +2187,15 @@ class TopRepoExpander(RepoExpanderBase):
         self.submodule_filter_helper.commit_callback(mono_commit)
 
         self.mono_id_to_commit[mono_commit.id] = mono_commit
+        submods = self.submodule_filter_helper.get_submodules(mono_commit)
         first_parent_id = mono_commit.first_parent()
         if first_parent_id is not None:
             first_parent = self.mono_id_to_commit[first_parent_id]
-            mono_commit.bumps = dict(first_parent.bumps)  # Copy
+            if submods:
+                mono_commit.bumps = dict(first_parent.bumps)  # Copy
+            else:
+                # No submodule changes, share the unmodified dict.
+                mono_commit.bumps = first_parent.bumps
         else:
             mono_commit.bumps = {}  # Dict[bytes, BumpInfo]
 
@@ -1616,7 +2205,6 @@ class TopRepoExpander(RepoExpanderBase):
             )
         ]
 
-        submods = self.submodule_filter_helper.get_submodules(mono_commit)
         for file_change, gitmodule_config in submods:
             _ = gitmodule_config
             if file_change.type == b"M":
@@ -1692,11 +2280,17 @@ class TopRepoExpander(RepoExpanderBase):
         sub repo that also needs to be merged. All those commits are resolved
         and inserted here.
         """
+        assert self.commit_map, "Program flow error, `self.commit_map` must be set."
+        # Local aliases for the lookups in the loops below.
+        subrepo_id_to_commit = self.commit_map.id_to_commit
+        mono_id_to_commit = self.mono_id_to_commit
+        subrepo_id_to_converted_id = self.subrepo_id_to_converted_id
         counter = itertools.count(start=0, step=1)
 
         def bump_generator(max_target_subrepo_depth: int) -> Generator:
-            mono_queue_ids: Set[int] = set()
-            mono_queue: PriorityQueue = PriorityQueue()
+            # Maps the queued ids to their insertion order.
+            mono_queue_ids: Dict[int, int] = {}
+            mono_queue: List[Tuple[int, git_filter_repo.Commit]] = []
 
             def add_possible_parent(
                 mono_parent: git_filter_repo.Commit, max_subrepo_depth: int
@@ -1713,23 +2307,21 @@ class TopRepoExpander(RepoExpanderBase):
                 # Prioritize by subrepo depth, not monorepo depth.
                 # Otherwise, we don't know when we have looked far
                 # enough as the depths are not correlated.
-                if bump.subrepo_commit.id not in mono_queue_ids:
-                    mono_queue_ids.add(bump.subrepo_commit.id)
-                    mono_queue.put(
+                order = next(counter)
+                if mono_queue_ids.setdefault(bump.subrepo_commit.id, order) == order:
+                    heapq.heappush(
+                        mono_queue,
                         (
-                            -bump.subrepo_commit.depth,
-                            next(counter),
+                            depth_priority(bump.subrepo_commit.depth, order),
                             mono_parent,
-                        )
+                        ),
                     )
 
             for pid in target_mono_commit.parents:
-                add_possible_parent(
-                    self.mono_id_to_commit[pid], max_target_subrepo_depth
-                )
+                add_possible_parent(mono_id_to_commit[pid], max_target_subrepo_depth)
 
-            while not mono_queue.empty():
-                _, _, mono_commit = mono_queue.get()
+            while len(mono_queue) != 0:
+                _, mono_commit = heapq.heappop(mono_queue)
                 # Return the latest commit pointing to a subrepo commit.
                 # This minimizes the length of feature branches before
                 # they are merged back in the history.
@@ -1738,23 +2330,26 @@ class TopRepoExpander(RepoExpanderBase):
                 bump: BumpInfo = mono_commit.bumps[subdir]
                 for pid in bump.first_mono_commit.parents:
                     add_possible_parent(
-                        self.mono_id_to_commit[pid], bump.subrepo_commit.depth - 1
+                        mono_id_to_commit[pid], bump.subrepo_commit.depth - 1
                     )
 
         bump_iterator = bump_generator(subrepo_commit_to_insert.depth - 1)
 
         commits_to_convert: List[git_filter_repo.Commit] = []
 
-        sub_queue_ids: Set[int] = set()
-        sub_queue: PriorityQueue = PriorityQueue()
-        sub_queue.put(
-            (-subrepo_commit_to_insert.depth, next(counter), subrepo_commit_to_insert)
-        )
+        # Maps the queued ids to their insertion order.
+        sub_queue_ids: Dict[int, int] = {}
+        sub_queue: List[Tuple[int, git_filter_repo.Commit]] = [
+            (
+                depth_priority(subrepo_commit_to_insert.depth, next(counter)),
+                subrepo_commit_to_insert,
+            )
+        ]
         # Get the loop going, initialize with something that
         # gets us into the inner loop.
         bump = BumpInfo(subrepo_commit=subrepo_commit_to_insert, first_mono_commit=None)
-        while not sub_queue.empty():
-            _, _, subrepo_commit = sub_queue.get()
+        while len(sub_queue) != 0:
+            _, subrepo_commit = heapq.heappop(sub_queue)
 
             while bump.subrepo_commit.depth >= subrepo_commit.depth:
                 # Some paths in the monorepo history has found a subrepo
@@ -1772,23 +2367,24 @@ class TopRepoExpander(RepoExpanderBase):
                 # the map should point to (one of the) newest commits.
                 # There might be multiple valid solutions,
                 # so just use the first one found.
-                self.subrepo_id_to_converted_id.setdefault(
+                subrepo_id_to_converted_id.setdefault(
                     bump.subrepo_commit.id, latest_bump_mono_commit.id
                 )
 
-            if subrepo_commit.id not in self.subrepo_id_to_converted_id:
+            if subrepo_commit.id not in subrepo_id_to_converted_id:
                 # No good already sub->mono converted candidate was found
                 # in the monorepo.
                 commits_to_convert.append(subrepo_commit)
                 for pid in subrepo_commit.parents:
-                    if pid not in sub_queue_ids:
-                        sub_queue_ids.add(pid)
-                        assert (
-                            self.commit_map
-                        ), "Program flow error, `self.commit_map` must be set."
-                        subrepo_parent = self.commit_map.id_to_commit[pid]
-                        sub_queue.put(
-                            (-subrepo_parent.depth, next(counter), subrepo_parent)
+                    order = next(counter)
+                    if sub_queue_ids.setdefault(pid, order) == order:
+                        subrepo_parent = subrepo_id_to_commit[pid]
+                        heapq.heappush(
+                            sub_queue,
+                            (
+                                depth_priority(subrepo_parent.depth, order),
+                                subrepo_parent,
+                            ),
                         )
 
         # Skip subrepo_commit_to_insert itself,
@@ -1800,25 +2396,25 @@ class TopRepoExpander(RepoExpanderBase):
                 target_mono_commit.branch,
                 subdir,
                 subrepo_commit,
-                self.subrepo_id_to_converted_id,
+                subrepo_id_to_converted_id,
             )
             repo_filter.insert(new_commit, direct_insertion=True)
-            self.mono_id_to_commit[new_commit.id] = new_commit
-            self.subrepo_id_to_converted_id[subrepo_commit.id] = new_commit.id
+            mono_id_to_commit[new_commit.id] = new_commit
+            subrepo_id_to_converted_id[subrepo_commit.id] = new_commit.id
             # Record subrepo trace info.
-            first_parent_id = new_commit.first_parent()
-            if first_parent_id is None:
-                new_commit.bumps = {}
-            else:
-                first_parent = self.mono_id_to_commit[first_parent_id]
-                new_commit.bumps = dict(first_parent.bumps)  # Copy
-            new_commit.bumps[subdir] = BumpInfo(
+            bump = BumpInfo(
                 subrepo_commit=subrepo_commit,
                 first_mono_commit=new_commit,
             )
+            first_parent_id = new_commit.first_parent()
+            if first_parent_id is None:
+                new_commit.bumps = {subdir: bump}
+            else:
+                first_parent = mono_id_to_commit[first_parent_id]
+                new_commit.bumps = chain_bumps(first_parent.bumps, subdir, bump)
 
         ret = [
-            self.subrepo_id_to_converted_id[parent_id]
+            subrepo_id_to_converted_id[parent_id]
             for parent_id in subrepo_commit_to_insert.parents
         ]
         ints = [-1] * len(ret)
@@ -1846,10 +2442,8 @@ class SubrepoCommitExpander(RepoExpanderBase):
         """
         subrepo_id_to_converted_id: Dict[RepoFilterId, RepoFilterId] = {}
 
-        sub_commit_hash: CommitHash = subprocess.check_output(
-            ["git", "-C", str(self.monorepo.path)]
-            + ["rev-parse", "--verify", "--quiet", subrepo_ref + "^{commit}"],
-        ).rstrip()
+        sub_commit_hash = self.monorepo.cat_file.resolve(subrepo_ref + "^{commit}")
+        assert sub_commit_hash is not None, f"{subrepo_ref} is missing"
         commits_to_convert, converted_commit_hash = self._resolve_commits_to_convert(
             subdir, sub_commit_hash, subrepo_id_to_converted_id
         )
@@ -1939,15 +2533,18 @@ class SubrepoCommitExpander(RepoExpanderBase):
         If multiple commits in the top repo set the submodule pointer to
         the same subrepo commit, the newest of them will be choosen.
         """
-        log_output = subprocess.check_output(
-            ["git", "-C", str(self.monorepo.path), "log", "--format=%H%n%B%x00"]
-            + mono_refs
-            + ["--"]
-        )
         subrepo_hash_to_mono_hash: Dict[CommitHash, CommitHash] = {}
-        for entry in log_output.split(b"\0\n"):
-            if entry == b"":
-                continue
+        # Let git skip the commits without an annotation for subdir, then only
+        # the matching messages need to be parsed here.
+        annotation = b"^-- " + subdir + b" "
+        for entry in git_output_records(
+            self.monorepo.path,
+            ["log", "--format=%H%n%B%x00"]
+            + ["--fixed-strings", "--grep", annotation.decode("utf-8")]
+            + mono_refs
+            + ["--"],
+            b"\0\n",
+        ):
             mono_commit_hash, message = entry.split(b"\n", 1)
             subrepo_commit_hash = try_parse_commit_hash_from_message(message, subdir)
             if subrepo_commit_hash is not None:
@@ -1974,14 +2571,16 @@ class SubrepoCommitExpander(RepoExpanderBase):
         commits_to_convert: List[git_filter_repo.Commit] = []
         # Also sort on insertion order because Commit is not comparable.
         counter = itertools.count(start=0, step=1)
-        todo_queue: PriorityQueue = PriorityQueue()
-        all_todo_ids: Set[RepoFilterId] = set()
+        todo_queue: List[Tuple[int, git_filter_repo.Commit]] = []
+        # Maps the queued ids to their insertion order.
+        all_todo_ids: Dict[RepoFilterId, int] = {}
         for commit in subrepo_commits:
-            todo_queue.put((-commit.depth, next(counter), commit))
-            all_todo_ids.add(commit.id)
+            order = next(counter)
+            heapq.heappush(todo_queue, (depth_priority(commit.depth, order), commit))
+            all_todo_ids[commit.id] = order
 
-        while not todo_queue.empty():
-            _, _, subrepo_commit = todo_queue.get()
+        while len(todo_queue) != 0:
+            _, subrepo_commit = heapq.heappop(todo_queue)
             mono_hash = subdir_hash_to_mono_hash.get(subrepo_commit.original_id)
             if mono_hash is not None:
                 # No need to convert, we found the base.
@@ -1993,10 +2592,13 @@ class SubrepoCommitExpander(RepoExpanderBase):
                 if isinstance(pid, CommitHash):
                     # Not enough history.
                     return None
-                if pid not in all_todo_ids:
+                order = next(counter)
+                if all_todo_ids.setdefault(pid, order) == order:
                     parent_commit = commit_map.id_to_commit[pid]
-                    todo_queue.put((-parent_commit.depth, next(counter), parent_commit))
-                    all_todo_ids.add(pid)
+                    heapq.heappush(
+                        todo_queue,
+                        (depth_priority(parent_commit.depth, order), parent_commit),
+                    )
         # Convert from the base first.
         commits_to_convert.reverse()
         return commits_to_convert
@@ -2031,8 +2633,9 @@ class SubrepoCommitExpander(RepoExpanderBase):
         repo_filter.finish()
 
 
-ParentsList = List[RepoFilterId]
-SubrepoParentsMap = Dict[bytes, ParentsList]
+# Ordered set, i.e. a dict with None values, for O(1) duplicate checks.
+ParentsSet = Dict[RepoFilterId, None]
+SubrepoParentsMap = Dict[bytes, ParentsSet]
 """Maps from subrepo dir to subrepo parent ids.
 
 subdir='' is used for the top repo.
@@ -2043,6 +2646,11 @@ class PushSplitError(ValueError):
     pass
 
 
+ls_tree_submodule_regex = re.compile(
+    rb"^160000 commit ([0-9a-f]+)\t(.*)$", re.MULTILINE
+)
+
+
 class PushSplitter:
     error: Optional[Exception]
 
@@ -2051,7 +2659,11 @@ class PushSplitter:
         self.toprepo = toprepo
         self.config = config
 
-        self.mono_id_to_subrepo_parent_ids: Dict[int, Dict[bytes, ParentsList]] = {}
+        self.mono_id_to_subrepo_parent_ids: Dict[int, SubrepoParentsMap] = {}
+        self.top_commit_subrepos: Dict[CommitHash, Dict[bytes, CommitHash]] = {}
+        """Caches the submodule pointers per top commit."""
+        self.mono_hash_to_top_hash: Dict[CommitHash, CommitHash] = {}
+        """Caches the top commit that each already filtered mono commit refers to."""
         self.submodule_filter_helper = SubmoduleFilterHelper(
             self.monorepo, config.top_push_url
         )
@@ -2115,7 +2727,7 @@ class PushSplitter:
 
         # Get parent commit hashes for each subrepo.
         # Each subdir might have a different set of parents.
-        subrepo_parent_ids_map: DefaultDict[bytes, ParentsList] = defaultdict(list)
+        subrepo_parent_ids_map: DefaultDict[bytes, ParentsSet] = defaultdict(dict)
         for mono_pid in mono_commit.parents:
             resolved_parent_map = self.mono_id_to_subrepo_parent_ids.get(mono_pid)
             if resolved_parent_map is not None:
@@ -2127,7 +2739,7 @@ class PushSplitter:
                     mono_pid, int
                 ), f"Expected mono commit {mono_pid} to have been processed"
                 for subdir, subrepo_pids in resolved_parent_map.items():
-                    unique_extend(subrepo_parent_ids_map[subdir], subrepo_pids)
+                    subrepo_parent_ids_map[subdir].update(subrepo_pids)
             else:
                 # Commit hash, not an ID.
                 # Get the original toprepo commit and find the subrepo pointers.
@@ -2135,33 +2747,26 @@ class PushSplitter:
                 assert isinstance(
                     mono_pid, CommitHash
                 ), f"Subrepo map not found for mono commit {mono_pid}"
-                mono_message = subprocess.check_output(
-                    ["git", "-C", str(self.monorepo.path)]
-                    + ["show", "--quiet", "--format=%B", mono_pid, "--"],
-                )
-                top_commit_hash = try_parse_top_hash_from_message(mono_message)
-                assert (
-                    top_commit_hash
-                ), f"No top commit hash in message: '{mono_message.decode()}'"
+                top_commit_hash = self._get_top_commit_hash(mono_pid)
                 subrepo_map = self._get_top_commit_subrepos(top_commit_hash)
                 # Extend the parents list for each subdir.
-                unique_append(subrepo_parent_ids_map[b""], top_commit_hash)
+                subrepo_parent_ids_map[b""][top_commit_hash] = None
                 for subdir, subrepo_commit_hash in subrepo_map.items():
-                    unique_append(subrepo_parent_ids_map[subdir], subrepo_commit_hash)
+                    subrepo_parent_ids_map[subdir][subrepo_commit_hash] = None
 
         # The commits might not exist in the target repo.
         # Split into parts.
         file_changes_per_subdir: Dict[bytes, List[git_filter_repo.FileChange]] = (
             defaultdict(list)
         )
+        submodule_configs = self.submodule_filter_helper.submodule_configs
         for file_change in mono_commit.file_changes:
-            for subdir in self.submodule_filter_helper.submodule_configs.keys():
-                path_prefix = subdir + b"/"
-                if file_change.filename.startswith(path_prefix):
-                    subrepo_fc = clone_file_change(file_change)
-                    subrepo_fc.filename = file_change.filename[len(path_prefix) :]
-                    file_changes_per_subdir[subdir].append(subrepo_fc)
-                    break
+            subdir = get_containing_subdir(file_change.filename, submodule_configs)
+            if subdir is not None:
+                subrepo_fc = clone_file_change(
+                    file_change, file_change.filename[len(subdir) + 1 :]
+                )
+                file_changes_per_subdir[subdir].append(subrepo_fc)
             else:
                 file_changes_per_subdir[b""].append(file_change)
         # Topic handling.
@@ -2180,8 +2785,8 @@ class PushSplitter:
             new_commit.message = trimmed_message
             new_commit.file_changes = file_changes
             # Exchange parents for the subrepo.
-            new_commit.parents = subrepo_parent_ids_map[subdir]
-            subrepo_parent_ids_map[subdir] = [new_commit.id]
+            new_commit.parents = list(subrepo_parent_ids_map[subdir])
+            subrepo_parent_ids_map[subdir] = {new_commit.id: None}
 
             repo = self._get_repo_from_subdir(subdir)
             new_branch = f"refs/repos/{repo.name}/toprepo/push"
@@ -2243,37 +2848,61 @@ class PushSplitter:
             )
         return repo
 
+    def _get_top_commit_hash(self, mono_commit_hash: CommitHash) -> CommitHash:
+        top_commit_hash = self.mono_hash_to_top_hash.get(mono_commit_hash)
+        if top_commit_hash is None:
+            # Read the raw commit object through the long running cat-file
+            # process instead of starting git-show for every commit.
+            mono_commit = self.monorepo.cat_file.read(mono_commit_hash.decode("utf-8"))
+            assert mono_commit is not None, f"Missing mono commit {mono_commit_hash!r}"
+            mono_message = mono_commit.split(b"\n\n", 1)[-1]
+            top_commit_hash = try_parse_top_hash_from_message(mono_message)
+            assert (
+                top_commit_hash
+            ), f"No top commit hash in message: '{mono_message.decode()}'"
+            self.mono_hash_to_top_hash[mono_commit_hash] = top_commit_hash
+        return top_commit_hash
+
     def _get_top_commit_subrepos(
         self, top_commit_hash: CommitHash
     ) -> Dict[bytes, CommitHash]:
+        subrepo_map = self.top_commit_subrepos.get(top_commit_hash)
+        if subrepo_map is None:
+            subrepo_map = self._list_top_commit_subrepos(top_commit_hash)
+            self.top_commit_subrepos[top_commit_hash] = subrepo_map
+        return subrepo_map
+
+    def _list_top_commit_subrepos(
+        self, top_commit_hash: CommitHash
+    ) -> Dict[bytes, CommitHash]:
+        # -d lists trees and submodules but no blobs.
         ls_tree_subrepo_stdout = subprocess.check_output(
             ["git", "-C", str(self.toprepo.path)]
-            + ["ls-tree", "-r", top_commit_hash, "--"],
+            + ["ls-tree", "-r", "-d", top_commit_hash, "--"],
         )
-        subrepo_map = {}
-        for line in ls_tree_subrepo_stdout.splitlines(keepends=False):
-            submodule_mode_and_type_prefix = b"160000 commit "
-            if line.startswith(submodule_mode_and_type_prefix):
-                hash_and_path = line[len(submodule_mode_and_type_prefix) :]
-                submod_hash, subdir = hash_and_path.split(b"\t", 1)
-                subrepo_map[subdir] = submod_hash
-        return subrepo_map
+        # Only the submodule lines are sliced out of the output.
+        return {
+            subdir: submod_hash
+            for submod_hash, subdir in ls_tree_submodule_regex.findall(
+                ls_tree_subrepo_stdout
+            )
+        }
 
     @staticmethod
     def _trim_push_commit_message(mono_message: bytes) -> bytes:
         # Avoid pushing cherry-picked commits with ^-- references.
-        trimmed_message = mono_message
-        idx = trimmed_message.rfind(b"\n^-- ")
-        if idx != -1:
-            # Try to remove a single trailing ^-- line from an upstream cherry-pick.
-            trimmed_message = trimmed_message[: idx + 1]  # Include LF
-        if b"\n^-- " in trimmed_message:
+        idx = mono_message.rfind(b"\n^-- ")
+        if idx == -1:
+            return mono_message
+        # Try to remove a single trailing ^-- line from an upstream cherry-pick.
+        # Search the part before it without slicing out a copy first.
+        if mono_message.find(b"\n^-- ", 0, idx + 1) != -1:
             raise PushSplitError(
                 "'^-- ' was found in the following commit message. "
                 + "It looks like a commit that already exists upstream.\n"
                 + textwrap.indent(mono_message.decode("utf-8"), "  ")
             )
-        return trimmed_message
+        return mono_message[: idx + 1]  # Include LF
 
 
 def main_init(args) -> int:
@@ -2371,6 +3000,7 @@ def main_refilter(args) -> int:
         top_refs=["--all"],
         allow_fetching=args.online,
         abort_on_missing=args.abort_on_missing,
+        jobs=args.jobs,
     ):
         return 1
     return 0
@@ -2404,17 +3034,15 @@ def main_fetch(args) -> int:
             git_module
         ), f"git module information is required for remote: {remote_name}"
         subexpander = SubrepoCommitExpander(monorepo)
-        for subrepo_config in config.repos:
-            if subrepo_config.name == remote_name:
-                repo_to_fetch = SubRepo(
-                    subrepo_config,
-                    monorepo.get_subrepo_dir(subrepo_config.name),
-                )
-                subdir = git_module.path.as_posix().encode("utf-8")
-                break
-        else:
+        subrepo_config = config.repos_by_name.get(remote_name)
+        if subrepo_config is None:
             print(f"ERROR: Could not resolve the remote {args.remote}")
             return 1
+        repo_to_fetch = SubRepo(
+            subrepo_config,
+            monorepo.get_subrepo_dir(subrepo_config.name),
+        )
+        subdir = git_module.path.as_posix().encode("utf-8")
 
     ref_args: List[str]
     if args.ref is None:
@@ -2425,6 +3053,7 @@ def main_fetch(args) -> int:
                 top_refs=["--all"],
                 allow_fetching=True,
                 abort_on_missing=args.abort_on_missing,
+                jobs=args.jobs,
             ):
                 return 1
         else:
@@ -2446,6 +3075,7 @@ def main_fetch(args) -> int:
                     top_refs=[top_fetch_head_ref, "--all"],
                     allow_fetching=True,
                     abort_on_missing=args.abort_on_missing,
+                    jobs=args.jobs,
                 ):
                     return 1
             else:
@@ -2489,13 +3119,19 @@ def main_push(args) -> int:
 
     # Push to each subrepo.
     repos_to_push = {push.repo.name: push.repo for push in push_instructions}
-    for repo in repos_to_push.values():
-        log_run_git(
-            monorepo.path,
-            ["push", "--quiet", "--force", str(repo.path.absolute())]
-            + [f"refs/repos/{repo.name}/toprepo/push:refs/toprepo/push"],
-            log_command=False,
-        )
+    run_concurrently(
+        [
+            partial(
+                log_run_git,
+                monorepo.path,
+                ["push", "--quiet", "--force", str(repo.path.absolute())]
+                + [f"refs/repos/{repo.name}/toprepo/push:refs/toprepo/push"],
+                log_command=False,
+            )
+            for repo in repos_to_push.values()
+        ],
+        jobs=args.jobs,
+    )
 
     # Sort per branch and remove unnecessary pushes.
     repo_to_pushes: DefaultDict[RepoName, List[PushInstruction]] = defaultdict(list)
@@ -2505,8 +3141,9 @@ def main_push(args) -> int:
             push_list.pop()
         push_list.append(new_push)
 
-    # Push per repo
-    for repo_name, push_list in repo_to_pushes.items():
+    # Push per repo. The pushes within a repo update the same remote ref, so
+    # they are run in order, but the different repos are pushed in parallel.
+    def push_in_order(push_list: List[PushInstruction]) -> None:
         for push in push_list:
             push_rev = push.commit_hash.decode("utf-8")
             log_run_git(
@@ -2518,6 +3155,12 @@ def main_push(args) -> int:
                 dry_run=args.dry_run,
                 check=False,
             )
+
+    repo_push_tasks = [
+        partial(push_in_order, push_list) for push_list in repo_to_pushes.values()
+    ]
+    # Keep the printed commands in order for --dry-run.
+    run_concurrently(repo_push_tasks, jobs=1 if args.dry_run else args.jobs)
     return 0
 
 
@@ -2666,6 +3309,15 @@ def _parse_arguments(argv: List[str]):
             action="store_true",
             help="Abort if there are unexpected missing commits. Default is to only warn.",
         )
+        subparser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            default=8,
+            help="""\
+                The number of submodules to fetch in parallel.
+                Defaults to 8.""",
+        )
 
     push_parser = subparsers.add_parser(
         "push",
@@ -2687,6 +3339,15 @@ def _parse_arguments(argv: List[str]):
             Use this option to push to manually push a different repository
             than the default configured 'origin'.""",
     )
+    push_parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=8,
+        help="""\
+            The number of repositories to push to in parallel.
+            Defaults to 8.""",
+    )
     push_parser.add_argument(
         "remote",
         type=str,
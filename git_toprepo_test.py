@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import shutil
 import subprocess
 from pathlib import Path, PurePosixPath
 
@@ -109,6 +110,44 @@ def test_config_repo_is_wanted():
     assert git_toprepo.Config.repo_is_wanted("Repo", ["-o"]) is None
     assert git_toprepo.Config.repo_is_wanted("Repo", ["-.*", "+Repo"])
     assert not git_toprepo.Config.repo_is_wanted("Repo", ["+.*", "-Repo"])
+    with pytest.raises(git_toprepo.ConfigParsingError, match="should start with"):
+        git_toprepo.Config.repo_is_wanted("Repo", ["Repo"])
+    with pytest.raises(git_toprepo.ConfigParsingError, match="Invalid wanted repo"):
+        git_toprepo.Config.repo_is_wanted("Repo", ["+("])
+
+
+def test_get_containing_subdir():
+    subdirs = {b"sub": None, b"dir/nested": None}
+    assert git_toprepo.get_containing_subdir(b"sub/file", subdirs) == b"sub"
+    assert git_toprepo.get_containing_subdir(b"sub/a/b", subdirs) == b"sub"
+    assert (
+        git_toprepo.get_containing_subdir(b"dir/nested/file", subdirs) == b"dir/nested"
+    )
+    assert git_toprepo.get_containing_subdir(b"dir/file", subdirs) is None
+    assert git_toprepo.get_containing_subdir(b"sub", subdirs) is None
+    assert git_toprepo.get_containing_subdir(b"subfile/x", subdirs) is None
+
+
+def test_chain_bumps():
+    root_bumps = {b"a": "a0", b"b": "b0"}
+    bumps = root_bumps
+    for i in range(1, 40):
+        parent_bumps = bumps
+        bumps = git_toprepo.chain_bumps(parent_bumps, b"a", f"a{i}")
+        assert dict(parent_bumps)[b"a"] == f"a{i - 1}"
+        assert bumps[b"a"] == f"a{i}"
+        assert bumps.get(b"b") == "b0"
+        assert bumps.get(b"c") is None
+    assert root_bumps == {b"a": "a0", b"b": "b0"}
+
+
+def test_depth_priority():
+    priorities = [
+        git_toprepo.depth_priority(depth, order)
+        for depth, order in [(1, 0), (3, 1), (1, 2), (0, 3), (3, 4)]
+    ]
+    # Deepest first, then in insertion order.
+    assert sorted(range(5), key=lambda i: priorities[i]) == [1, 4, 0, 2, 3]
 
 
 def test_annotate_message():
@@ -188,20 +227,32 @@ message, extra LFs
 
 def test_join_annotated_commit_messages():
     boring_messages = [
-        b"Update git submodules\n^-- <top> 123hash\n",
+        b"Update git submodules\n\n^-- <top> 123hash\n",
+        b"Update git submodules\n\n^-- <top> 456hash\n",
     ]
     nice_messages = [
         b"An amazing feature\n^-- sub/dir 123hash\n",
+        b"Another feature\n^-- other/dir 456hash\n",
     ]
     expected_message = b"".join(nice_messages + boring_messages)
 
-    git_toprepo.join_annotated_commit_messages(
-        boring_messages + nice_messages
-    ) == expected_message
+    assert (
+        git_toprepo.join_annotated_commit_messages(boring_messages + nice_messages)
+        == expected_message
+    )
 
-    git_toprepo.join_annotated_commit_messages(
-        nice_messages + boring_messages
-    ) == expected_message
+    assert (
+        git_toprepo.join_annotated_commit_messages(nice_messages + boring_messages)
+        == expected_message
+    )
+
+    # The relative order is kept.
+    assert (
+        git_toprepo.join_annotated_commit_messages(
+            [boring_messages[0], nice_messages[0], boring_messages[1], nice_messages[1]]
+        )
+        == expected_message
+    )
 
 
 def test_try_parse_commit_hash_from_message():
@@ -227,6 +278,15 @@ message
         )
         is None
     )
+    # The subdir is matched literally.
+    assert (
+        git_toprepo.try_parse_commit_hash_from_message(example_message, b"sub.dir")
+        is None
+    )
+    with pytest.raises(ValueError, match="Multiple hashes found for 'sub/dir'"):
+        git_toprepo.try_parse_commit_hash_from_message(
+            example_message + b"^-- sub/dir 456def\n", b"sub/dir"
+        )
 
 
 def test_try_get_topic_from_message():
@@ -266,6 +326,9 @@ Another: another footer
 """
     assert git_toprepo.try_get_topic_from_message(example_message_no_topic) is None
 
+    with pytest.raises(ValueError, match="Expected a single footer"):
+        git_toprepo.try_get_topic_from_message(example_message + b"Topic: other\n")
+
     example_message_multiple_topics = b"""\
 Subject line
 
@@ -280,6 +343,15 @@ Another: another footer
         git_toprepo.try_get_topic_from_message(example_message_multiple_topics)
 
 
+def test_trim_push_commit_message():
+    trim = git_toprepo.PushSplitter._trim_push_commit_message
+    assert trim(b"Subject\n\nBody\n") == b"Subject\n\nBody\n"
+    # A single trailing annotation from a cherry-pick is removed.
+    assert trim(b"Subject\n^-- sub/dir 123abc\n") == b"Subject\n"
+    with pytest.raises(git_toprepo.PushSplitError, match="already exists upstream"):
+        trim(b"Subject\n^-- sub/dir 123abc\n^-- <top> 456def\n")
+
+
 def test_remote_to_repo():
     git_modules = [
         git_toprepo.GitModuleInfo(
@@ -335,6 +407,37 @@ def test_remote_to_repo():
     assert git_toprepo.remote_to_repo("no/subrepo", git_modules, config) is None
 
 
+def test_remote_to_repo_ambiguous(capsys):
+    git_modules = [
+        git_toprepo.GitModuleInfo(
+            name=f"submodule-{path}",
+            path=PurePosixPath(path),
+            branch=".",
+            url="ssh://github.com/org/subrepo",
+            raw_url="../subrepo",
+        )
+        for path in ["b", "a"]
+    ]
+    config = git_toprepo.Config(
+        missing_commits={},
+        top_fetch_url="ssh://user@toprepo/fetch",
+        top_push_url="ssh://user@toprepo/push",
+        repos=[
+            git_toprepo.RepoConfig(
+                name="sub",
+                enabled=True,
+                raw_urls=["../subrepo"],
+                fetch_url="ssh://user@subrepo/fetch",
+                fetch_args=[],
+                push_url="ssh://user@subrepo/push",
+            ),
+        ],
+    )
+    assert git_toprepo.remote_to_repo("org/subrepo", git_modules, config) is None
+    outerr = capsys.readouterr()
+    assert outerr.out == "ERROR: Multiple remote candidates: sub (at a/, b/)\n"
+
+
 def commit_env(seed: str = ""):
     """With this env, commits become deterministic."""
     name_suffix = str(hash(seed))
@@ -356,16 +459,10 @@ class GitTopRepoExample:
         server_config = self.tmp_path / "server/config"
         server_config.mkdir(parents=True)
         subprocess.check_call(cwd=server_config, args="git init --quiet".split(" "))
+        # Start directly on config-branch, no need for any other branch.
         subprocess.check_call(
             cwd=server_config,
-            args="git commit -q -m InitialCommit --allow-empty".split(" "),
-            env=commit_env(),
-        )
-        subprocess.check_call(
-            cwd=server_config, args="git branch -q config-branch".split(" ")
-        )
-        subprocess.check_call(
-            cwd=server_config, args="git checkout -q config-branch".split(" ")
+            args="git symbolic-ref HEAD refs/heads/config-branch".split(" "),
         )
         (server_config / "toprepo.config").write_text(
             "[toprepo.missing-commits]\nrev-test-hash = some-path"
@@ -412,6 +509,11 @@ class GitTopRepoExample:
         )
         return server_top
 
+    def copy_server_top(self, prebuilt_server: Path) -> Path:
+        """Like init_server_top, but copies the repositories from prebuilt_server."""
+        shutil.copytree(prebuilt_server, self.tmp_path / "server")
+        return self.tmp_path / "server/top"
+
     def git_init_worktree(self, server_top: Path) -> git_toprepo.MonoRepo:
         worktree_path = self.tmp_path / "worktree"
         worktree_path.mkdir(parents=True)
@@ -460,7 +562,15 @@ class GitTopRepoExample:
         return git_toprepo.MonoRepo(worktree_path)
 
 
-def test_get_config_location(tmp_path):
+@pytest.fixture(scope="session")
+def prebuilt_server(tmp_path_factory) -> Path:
+    """The server repositories of GitTopRepoExample, created once per session."""
+    tmp_path = tmp_path_factory.mktemp("prebuilt")
+    GitTopRepoExample(tmp_path).init_server_top()
+    return tmp_path / "server"
+
+
+def test_get_config_location(tmp_path, prebuilt_server):
     """Test storing the configuration remotely.
 
     The test fixture includes the server/top git repository
@@ -469,7 +579,7 @@ def test_get_config_location(tmp_path):
     refs/heads/config-branch.
     """
     example = GitTopRepoExample(tmp_path)
-    server_top = example.init_server_top()
+    server_top = example.copy_server_top(prebuilt_server)
     worktree = example.toprepo_init_worktree(server_top)
 
     config_dict = git_toprepo.ConfigAccumulator(
@@ -481,6 +591,22 @@ def test_get_config_location(tmp_path):
     ]
 
 
+def test_load_missing_config(tmp_path, capsys):
+    """A missing config file is reported as an error, not a traceback."""
+    subprocess.check_call(["git", "init", "--quiet", str(tmp_path)])
+    for key in ["remote.origin.url", "remote.top.pushurl"]:
+        subprocess.check_call(
+            ["git", "-C", str(tmp_path), "config", key, "file:///nowhere"]
+        )
+    monorepo = git_toprepo.MonoRepo(tmp_path)
+    capsys.readouterr()  # Reset the stdout capture.
+    config_accumulator = git_toprepo.ConfigAccumulator(monorepo, online=False)
+    assert config_accumulator.try_load_main_config() is None
+    outerr = capsys.readouterr()
+    assert outerr.out.startswith("ERROR: Could not load the configuration: ")
+    assert "toprepo.config is missing" in outerr.out
+
+
 def test_read_config_from_git(tmp_path):
     """Test the LocalGitConfigLoader."""
     worktree_path = tmp_path / "worktree"
@@ -499,6 +625,26 @@ def test_read_config_from_git(tmp_path):
     assert config_dict["toprepo.missing-commits.rev-test-hash"] == ["local-config"]
 
 
+def test_toprepo_fetch_url_migration(tmp_path, prebuilt_server):
+    """Test migrating from toprepo.top.* to remote.*."""
+    example = GitTopRepoExample(tmp_path)
+    server_top = example.copy_server_top(prebuilt_server)
+    worktree = example.git_init_worktree(server_top)
+    subprocess.check_call(
+        cwd=worktree.path,
+        args=["git", "config", "toprepo.top.pushUrl", "ssh://toprepo/push"],
+    )
+
+    fetch_url = f"file://{server_top.absolute()}"
+    assert worktree.get_toprepo_fetch_url() == fetch_url
+    assert worktree.git_config["remote.origin.url"] == [fetch_url]
+    # The migrated values should have been written to disk.
+    config_dict = git_toprepo.LocalGitConfigLoader(worktree).get_config_dict()
+    assert config_dict["remote.origin.url"] == [fetch_url]
+    assert config_dict["remote.origin.pushurl"] == ["file:///dev/null"]
+    assert config_dict["remote.top.pushurl"] == ["ssh://toprepo/push"]
+
+
 def test_read_config_from_disk(tmp_path):
     """Test the LocalFileConfigLoader."""
     config_path = tmp_path / "config"
@@ -541,9 +687,226 @@ def test_read_config_casing(tmp_path):
     }
 
 
-def test_get_config(tmp_path, capsys):
+def test_referenced_submod_commits_cache(tmp_path):
+    cache_file = tmp_path / "cache"
+    collector = git_toprepo.ReferencedSubmodCommitsCollector
+    assert collector.load_cache(cache_file) == {}
+    commit_to_submod_commits = {
+        b"top1": [],
+        b"top2": [("../sub", b"sub1"), ("https://host/a b", b"sub2")],
+    }
+    collector.save_cache(cache_file, commit_to_submod_commits)
+    assert collector.load_cache(cache_file) == commit_to_submod_commits
+
+
+def test_referenced_submod_commits_collect(tmp_path, monkeypatch):
+    """Only new commits are traversed, cached results are still returned."""
+    top_path = tmp_path / "top"
+    subprocess.check_call(["git", "init", "--quiet", str(top_path)])
+    (top_path / ".gitmodules").write_text(
+        '[submodule "sub"]\n\tpath = sub\n\turl = ../sub\n'
+    )
+    subprocess.check_call(["git", "-C", str(top_path), "add", ".gitmodules"])
+
+    def commit_submod(submod_commit: bytes):
+        subprocess.check_call(
+            ["git", "-C", str(top_path), "update-index", "--add", "--cacheinfo"]
+            + [f"160000,{submod_commit.decode('utf-8')},sub"]
+        )
+        subprocess.check_call(
+            ["git", "-C", str(top_path), "commit", "-q", "-m", "Bump"],
+            env=commit_env(submod_commit.decode("utf-8")),
+        )
+
+    toprepo = git_toprepo.TopRepo(
+        top_path, fetch_url="file:///top", push_url="file:///top"
+    )
+    collector = git_toprepo.ReferencedSubmodCommitsCollector
+    cache_file = toprepo.git_dir / collector.cache_filename
+
+    commit_submod(b"1" * 40)
+    assert collector.collect(toprepo) == {"../sub": {b"1" * 40}}
+    first_top_commit = subprocess.check_output(
+        ["git", "-C", str(top_path), "rev-parse", "HEAD"]
+    ).strip()
+    assert collector.load_cache(cache_file) == {
+        first_top_commit: [("../sub", b"1" * 40)]
+    }
+
+    # Fake the cached result to prove that the cached commit is not revisited.
+    collector.save_cache(cache_file, {first_top_commit: [("../sub", b"f" * 40)]})
+    commit_submod(b"2" * 40)
+    assert collector.collect(toprepo) == {"../sub": {b"f" * 40, b"2" * 40}}
+    cached = collector.load_cache(cache_file)
+    assert len(cached) == 2
+    assert cached[first_top_commit] == [("../sub", b"f" * 40)]
+
+    # Too many cached tips to exclude, so the full history is walked again.
+    monkeypatch.setattr(collector, "max_excluded_tips", 0)
+    commit_submod(b"3" * 40)
+    assert collector.collect(toprepo) == {"../sub": {b"1" * 40, b"2" * 40, b"3" * 40}}
+    assert len(collector.load_cache(cache_file)) == 3
+
+
+def test_config_dict_parse():
+    config_dict = git_toprepo.ConfigDict.parse("a.b=1\na.c\na.b=2=3\n")
+    assert config_dict == {"a.b": ["1", "2=3"], "a.c": [""]}
+
+
+def test_parse_git_config_content():
+    """Test that parsing without git gives the same result as git-config."""
+    content = """\
+# A comment.
+[toprepo.missing-commits]
+    Lower-Case = local-config ; A comment.
+    Lower-Case = "  quoted # value  "
+[toprepo "Keep_Casing\\"\\\\"]
+    Foo = "Casing Kept"  \\t  escaped\\\\
+    empty =
+    boolean
+[Old.Style]
+    key=value
+"""
+    expected = subprocess.check_output(
+        ["git", "config", "--file", "-", "--list"], input=content, text=True
+    )
+    entries = git_toprepo.parse_git_config_content(content)
+    assert entries is not None
+    assert (
+        "".join(
+            f"{key}\n" if value is None else f"{key}={value}\n"
+            for key, value in entries
+        )
+        == expected
+    )
+
+    # Let git handle the corner cases.
+    assert git_toprepo.parse_git_config_content("[a]\n  b = c\\\n  d\n") is None
+    assert git_toprepo.parse_git_config_content("[a] b = c\n") is None
+    assert git_toprepo.parse_git_config_content("[a]\n  b = c\td\n") is None
+    assert git_toprepo.parse_git_config_content('[a]\n  b = "c\n') is None
+
+    # Unsupported syntax falls back to git itself.
+    for content in ["[a]\n  b = c\n  d\n", "[a] b = c\n  d\n"]:
+        config_loader = git_toprepo.StaticContentConfigLoader(content)
+        assert config_loader.get_config_dict() == {"a.b": ["c"], "a.d": [""]}
+
+
+def test_fetch_remote_configs(monkeypatch):
+    fetched = []
+
+    class FetchingConfigLoader(git_toprepo.StaticContentConfigLoader):
+        def fetch_remote_config(self) -> None:
+            if self.content == "fail":
+                raise RuntimeError("Failed to fetch")
+            fetched.append(self.content)
+
+    git_toprepo.fetch_remote_configs(
+        [FetchingConfigLoader("a"), FetchingConfigLoader("b")]
+    )
+    assert sorted(fetched) == ["a", "b"]
+
+    with pytest.raises(RuntimeError, match="Failed to fetch"):
+        git_toprepo.fetch_remote_configs(
+            [FetchingConfigLoader("c"), FetchingConfigLoader("fail")]
+        )
+    assert "c" in fetched
+
+    # Git configurations from the same remote are fetched together.
+    fetched_together = []
+    monkeypatch.setattr(
+        git_toprepo.GitRemoteConfigLoader,
+        "fetch_together",
+        lambda config_loaders: fetched_together.append(
+            [config_loader.local_ref for config_loader in config_loaders]
+        ),
+    )
+    repo = git_toprepo.Repo(Path("repo"))
+    git_toprepo.fetch_remote_configs(
+        [
+            git_toprepo.GitRemoteConfigLoader(
+                url, "refs/heads/main", PurePosixPath("toprepo.config"), repo, ref
+            )
+            for url, ref in [("a", "refs/x"), ("b", "refs/y"), ("a", "refs/z")]
+        ]
+    )
+    assert sorted(fetched_together) == [["refs/x", "refs/z"], ["refs/y"]]
+
+
+def test_load_config_overrides(tmp_path):
+    subprocess.check_call(["git", "init", "--quiet", str(tmp_path)])
+    (tmp_path / "a.config").write_text(
+        """\
+[toprepo.config.b]
+    type = file
+    path = b.config
+[x]
+    y = a
+"""
+    )
+    (tmp_path / "b-override.config").write_text("[x]\n    y = b-override\n")
+    config_loader = git_toprepo.StaticContentConfigLoader(
+        """\
+[toprepo.config.a]
+    type = file
+    path = a.config
+[toprepo.config.b]
+    partial = true
+    path = b-override.config
+[x]
+    y = root
+"""
+    )
+    accumulator = git_toprepo.ConfigAccumulator(
+        git_toprepo.MonoRepo(tmp_path), online=False
+    )
+    config_dict = accumulator.load_config(config_loader)
+    # Earlier loaded configs override later loaded configs.
+    assert config_dict["x.y"] == ["b-override", "a", "root"]
+    assert config_dict["toprepo.config.b.path"] == ["b.config", "b-override.config"]
+
+
+def test_git_cat_file_batch(tmp_path):
+    subprocess.check_call(["git", "init", "--quiet", str(tmp_path)])
+    (tmp_path / "file name").write_text("content\n")
+    subprocess.check_call(["git", "-C", str(tmp_path), "add", "file name"])
+    subprocess.check_call(
+        ["git", "-C", str(tmp_path), "commit", "--quiet", "-m", "Add file"],
+        env=commit_env(),
+    )
+    cat_file = git_toprepo.GitCatFileBatch(tmp_path)
+    assert cat_file.read("HEAD:file name") == b"content\n"
+    assert cat_file.read("HEAD:missing") is None
+    # The name is echoed back for missing objects, spaces included.
+    assert cat_file.read("HEAD:my toprepo.config") is None
+    assert cat_file.resolve("HEAD:a b") is None
+    assert cat_file.read("HEAD:file name") == b"content\n"
+    head = subprocess.check_output(["git", "-C", str(tmp_path), "rev-parse", "HEAD"])
+    assert cat_file.resolve("HEAD^{commit}") == head.rstrip()
+    assert cat_file.resolve("HEAD~1^{commit}") is None
+    cat_file.close()
+
+
+def test_git_output_records(tmp_path):
+    subprocess.check_call(["git", "init", "--quiet", str(tmp_path)])
+    for message in ["First", "Second\n\nBody"]:
+        subprocess.check_call(
+            ["git", "-C", str(tmp_path), "commit", "--quiet", "--allow-empty"]
+            + ["-m", message],
+            env=commit_env(),
+        )
+    # A tiny chunk size splits the separator between reads.
+    records = git_toprepo.git_output_records(
+        tmp_path, ["log", "--format=%B%x00"], b"\0\n", chunk_size=3
+    )
+    assert list(records) == [b"Second\n\nBody\n", b"First\n"]
+    with pytest.raises(subprocess.CalledProcessError):
+        list(git_toprepo.git_output_records(tmp_path, ["log", "bad-ref"], b"\n"))
+
+
+def test_get_config(tmp_path, capsys, prebuilt_server):
     example = GitTopRepoExample(tmp_path)
-    server_top = example.init_server_top()
+    server_top = example.copy_server_top(prebuilt_server)
     worktree = example.toprepo_init_worktree(server_top)
 
     capsys.readouterr()  # Reset the stdout capture.
@@ -558,9 +921,9 @@ def test_get_config(tmp_path, capsys):
     assert outerr.out == "local-override-path\n"
 
 
-def test_list_config(tmp_path, capsys, monkeypatch):
+def test_list_config(tmp_path, capsys, monkeypatch, prebuilt_server):
     example = GitTopRepoExample(tmp_path)
-    server_top = example.init_server_top()
+    server_top = example.copy_server_top(prebuilt_server)
     worktree = example.toprepo_init_worktree(server_top)
 
     envs = os.environ.copy()
@@ -598,30 +961,37 @@ toprepo.missing-commits.rev-test-hash=local-override-path
     )
 
 
+@pytest.mark.skip(reason="Not implemented yet")
 def test_init_fetch_checkout():
     pass
 
 
+@pytest.mark.skip(reason="Not implemented yet")
 def test_fetch_fast_filter():
     pass
 
 
+@pytest.mark.skip(reason="Not implemented yet")
 def test_push():
     pass
 
 
+@pytest.mark.skip(reason="Not implemented yet")
 def test_refilter_offline():
     pass
 
 
+@pytest.mark.skip(reason="Not implemented yet")
 def test_refilter_from_scratch():
     pass
 
 
+@pytest.mark.skip(reason="Not implemented yet")
 def test_missing_commits():
     pass
 
 
+@pytest.mark.skip(reason="Not implemented yet")
 def test_filtering_keeps_workspace():
     # No git-clean
     # No git-reset-hard